@@ -1,2 +1,15 @@
 from .async_bacdive import bacdive_async
 from .async_lpsn import lpsn_async
+from .cache import response_cache, record_cache
+from .search import search_result
+from .decoding import json_decoder
+from .metrics import memory_sink, prometheus_sink, otel_sink, retrieval_summary
+from .checkpoint import retrieval_checkpoint
+from .mirror import mirror
+from .index import strain_index
+from .export import flattener, export_async
+from .projection import projection
+from .sync import sync_client
+from .enrich import enrich_async, taxon_linker
+from .sharded import sharded_crawler
+from .scheduler import priority
@@ -1,17 +1,53 @@
 # Extend the bacdive client to add multithreaded retrieval
-from keycloak.exceptions import KeycloakAuthenticationError, KeycloakPostError, KeycloakConnectionError
 import json
-import aiohttp
 import asyncio
 import bacdive
-class bacdive_async(bacdive.BacdiveClient):
-    def __init__(self, user, password, public=True, max_retries=3, retry_delay=10, request_timeout=60000):
-        super().__init__(user, password, public, max_retries, retry_delay, request_timeout)
-        self.session = None
-        self.conn = None
-        self._lock = asyncio.Lock()
-        self.sem = asyncio.Semaphore(50)
+from .client import dsmz_async
+from .streaming import bounded_as_completed
+from . import auth
+from .search import search_result
+from .projection import projection_for
+from .batching import unique
+class bacdive_async(dsmz_async, bacdive.BacdiveClient):
+    source = 'bacdive'
+    client_id = "api.bacdive.public"
+    base_urls = {True: "https://api.bacdive.dsmz.de/", False: "http://api.bacdive-dev.dsmz.local/"}
+    limits = {'initial': 50, 'maximum': 200}
+    connections = 200
 
+    def __init__(self, user, password, public=True, max_retries=3, retry_delay=10, request_timeout=300, cache=None, record_cache=None, sso_url=None, api_url=None):
+        if sso_url is None:
+            super().__init__(user, password, public, max_retries, retry_delay, request_timeout)
+        else:
+            self._authenticate(user, password, public, max_retries, retry_delay, request_timeout, sso_url)
+        self._setup(cache, record_cache, api_url)
+        self._remember_login(user, password)
+
+    def _setup(self, cache, record_cache, api_url, session=None, tokens=None):
+        super()._setup(cache, record_cache, api_url, session, tokens)
+        # (kind, accession) -> BacDive-IDs, filled by resolve_accessions
+        self.accession_ids = {}
+
+    def _configure(self, public, max_retries, retry_delay, request_timeout, sso_url):
+        super()._configure(public, max_retries, retry_delay, request_timeout, sso_url)
+        self.predictions = False
+        self.search_type = False
+
+    @classmethod
+    async def create(cls, user=None, password=None, public=True, max_retries=3, retry_delay=10, request_timeout=300, cache=None, record_cache=None, sso_url=None, api_url=None, session=None, tokens=None):
+        ''' Build and authenticate a client without blocking the event loop.
+
+        Authentication and token refreshes go through the client's aiohttp
+        session, the same one used for the API calls. Pass the `session`
+        and/or `tokens` of another client to share them (no credentials are
+        needed then); a shared session stays open until its owner closes it.
+        Raises the Keycloak exception if the login fails. Use as
+        `async with await bacdive_async.create(user, password) as client:`.
+        '''
+        self = cls.__new__(cls)
+        self._configure(public, max_retries, retry_delay, request_timeout, sso_url or auth.SSO_URLS[public])
+        self._setup(cache, record_cache, api_url, session, tokens)
+        return await self._login_async(user, password, tokens)
 
     def do_api_call(self, url):
         ''' Initialize API call on given URL and returns result as json '''
@@ -19,6 +55,8 @@ class bacdive_async(bacdive.BacdiveClient):
             baseurl = "https://api.bacdive.dsmz.de/"
         else:
             baseurl = "http://api.bacdive-dev.dsmz.local/"
+        if self.api_url:
+            baseurl = self.api_url
         
         if not url.startswith("http"):
             # if base is missing add default:
@@ -44,104 +82,14 @@ class bacdive_async(bacdive.BacdiveClient):
             return msg
         else:
             return json.loads(resp.content)
-    async def get_session(self):
-        async with self._lock:
-            if self.conn is None:
-                self.conn = aiohttp.TCPConnector(limit=200)
-            if self.session is None:
-                self.session = aiohttp.ClientSession(
-                    timeout=aiohttp.ClientTimeout(total=60000),
-                    connector=self.conn
-                )
-            return self.session
-    async def refresh_tokens(self):
-        try:
-            token = self.keycloak_openid.refresh_token(self.refresh_token)
-            self.access_token = token['access_token']
-            self.refresh_token = token['refresh_token']
-        except (KeycloakAuthenticationError, KeycloakPostError, KeycloakConnectionError) as e:
-            raise e
-        return token
-
-    async def close(self):
-        await self.session.close()
-        await self.conn.close()
-        self.session = None
-        self.conn = None
-        return self.session
-
-    async def do_request_async(self, url):
-        """Async HTTP GET with retry + token auth"""
-
-        if self.predictions:
-            if "?" in url:
-                url += "&predictions=1"
-            else:
-                url += "?predictions=1"
-        if self.session is None:
-            try:
-                self.session = await self.get_session()
-            except Exception as e:
-                print(f"Error getting session: {e}")
-                return {}, {}
-        timeout = aiohttp.ClientTimeout(total=self.request_timeout)
-        async with self.sem:
-            for attempt in range(1, self.max_retries + 1):
-                headers = {
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self.access_token}"}
-                try:
-                    async with self.session.get(url, headers=headers, timeout=timeout) as resp:
-                        if resp.status == 401:
-                            # refresh token
-                            await self.refresh_tokens()
-                            continue
-                        
-                        if resp.status in [429, 500, 502, 503, 504]:
-                            # Retryable errors
-                            await self.refresh_tokens()
-                            # await self.session.close()
-                            # self.session = await self.get_session()
-                            await asyncio.sleep(2 ** attempt)
-                            continue
-
-                        # Return JSON for non-error statuses
-                        data = await resp.json()
-                        return resp, data
 
-                except aiohttp.ClientError as e:
-                    await self.refresh_tokens()
-                    await asyncio.sleep(2 ** attempt)
-                    print(f"Retrying {url}, attempt {attempt}")
-                
+    def _records_of(self, result):
+        ''' {BacDive-ID: record} of a fetch/ response, None if it failed '''
+        fetched = result.get("results") if isinstance(result, dict) else None
+        if not isinstance(fetched, dict):
+            return None
+        return {str(k): v for k, v in fetched.items()}
 
-        raise RuntimeError(f"Failed to GET {url} after {self.max_retries} retries {resp.status if 'resp' in locals() else 'No Response'}")
-    async def do_api_call_async(self, url):
-            baseurl = (
-                "https://api.bacdive.dsmz.de/" if self.public else "http://api.bacdive-dev.dsmz.local/"
-            )
-            if not url.startswith("http"):
-                url = baseurl + url
-            try:
-                resp, data = await self.do_request_async(url)
-            except Exception as e:
-                print(f"Error retrieving data from request_async {url}: {e}")
-                # print(resp, data)
-                return {}
-            if resp.status in (500, 400, 503):
-                print(f"Error {resp.status}: {data}")
-                token = await self.refresh_tokens()
-                self.access_token = token['access_token']
-                self.refresh_token = token['refresh_token']
-                return data
-            elif (resp.status == 401):
-                # Access token might have expired (15 minutes life time).
-                # Get new tokens using refresh token and try again.
-                token = await self.refresh_tokens()
-                self.access_token = token['access_token']
-                self.refresh_token = token['refresh_token']
-                return await self.do_api_call_async(url)
-            return data
     async def parse_entries_async(self, url):
         try:
             result = await self.do_api_call_async(url)
@@ -151,85 +99,51 @@ class bacdive_async(bacdive.BacdiveClient):
         try:
             if result.get('results') == []:
                 return []
-            ids = ";".join(str(i) for i in result['results'])
-            entries = await self.do_api_call_async(f"fetch/{ids}")
-            # print(f"Retrieved {len(entries['results'])} entries from {url}")
-            # print(f"First entry: {entries['results'].keys()}")
-            return [el for el in entries["results"].values()] if isinstance(entries.get("results"), dict) else []
+            return await self.fetch_entries_async(result['results'])
         except Exception as e:
             print(f"Error parsing entries from {url}: {e}")
             return []
 
-    
-    async def retrieve_async(self, url=None):
+    async def retrieve_async(self, url=None, handle=None, listing_workers=10, fetch_workers=20, checkpoint=None,
+                             fields=None, compact=False):
+        ''' Retrieve all entries of the search at `url`, of `handle` or of the
+        current search; see dsmz_async.retrieve_async for the options '''
+        return await super().retrieve_async(handle, listing_workers, fetch_workers, checkpoint, fields, compact, url)
+
+    def _page_urls(self, url, count):
+        ''' Build the listing URLs for every page of a search with `count` hits '''
+        num_jobs = max(0, (count - 1) // 100)
+        # predictions=1 is added by do_request_async
+        if num_jobs == 0:
+            return [url]
+        sep = "&" if "?" in url else "?"
+        return [f"{url}{sep}page={i}" for i in range(num_jobs + 1)]
+
+    def aiter_records(self, url=None, handle=None, listing_workers=10, fetch_workers=20, fields=None,
+                      compact=False):
+        ''' Yield the entries of the search at `url`, of `handle` or of the current
+        search as each fetch/ batch finishes, see dsmz_async.aiter_records '''
+        return super().aiter_records(handle, listing_workers, fetch_workers, fields, compact, url)
+
+    stream = aiter_records
+
+    async def export_async(self, path, url=None, handle=None, format=None, batch_size=1000, **options):
+        ''' Stream the entries of a search into a JSONL or Parquet file, see dsmz_async.export_async '''
+        return await super().export_async(path, handle, format, batch_size, url, **options)
+
+    async def search_many(self, queries, concurrency=20, fields=None, compact=False):
+        ''' Run many searches, each a dict of async_search parameters, and yield
+        (query, entries) as each query completes. No instance state is changed.
+        '''
         self.session = await self.get_session()
-        # async with self.session as session:
-        if url is not None:
-            result = await self.do_api_call_async(url)
-            try:
-                num_jobs = (result['count'] -1) // 100
-            except Exception as e:
-                print(f"Error retrieving count from result: {e}")
-                print(result)
-                return []
-            if num_jobs < 0:
-                return []
-            elif num_jobs == 0:
-                ids = ";".join(str(i) for i in result['results'])
-                entries = await self.do_api_call_async(f"fetch/{ids}")
-                return [el for el in entries["results"].values()] if isinstance(entries.get("results"), dict) else []
-            urls = [f"{url}?page={i}" for i in range(num_jobs + 1) ]
-        else:
-            # self.session = session  # temporarily assign for internal methods
-            try:
-                num_jobs = (self.result['count'] -1) // 100
-                if num_jobs < 0:
-                    num_jobs = 0
-            except Exception as e:
-                print(f"Error retrieving count from result: {e}")
-                print(self.result)
-                return []
-            # prepare URLs for all pages
-            if "?" in self.url:
-                if self.predictions:
-                    if num_jobs == 0:
-                        urls = [f"{self.url}&predictions=1"]
-                    else:
-                        urls = [f"{self.url}&predictions=1&page={i}" for i in range(num_jobs + 1)]
-                else:
-                    if num_jobs == 0:
-                        urls = [f"{self.url}"]
-                    else:
-                        urls = [f"{self.url}&page={i}" for i in range(num_jobs + 1)]
-            else:
-                if self.predictions:
-                    if num_jobs == 0:
-                        urls = [f"{self.url}?predictions=1"]
-                    else:
-                        urls = [f"{self.url}?predictions=1&page={i}" for i in range(num_jobs + 1)]
-                else:
-                    if num_jobs == 0:
-                        urls = [f"{self.url}"]
-                    else:
-                        urls = [f"{self.url}?page={i}" for i in range(num_jobs + 1)]                
-        try:
-            tasks = [self.parse_entries_async(url) for url in urls]
-        except Exception as e:
-            print(f"Error creating tasks for URLs: {e}")
-            print(num_jobs, urls)
-        all_results = await asyncio.gather(*tasks, return_exceptions=True)
 
-        # flatten the results
-        return [item for sublist in all_results for item in sublist]
-    def retrieve(self):
-        async def runner():
-            try:
-                return await self.retrieve_async()
-            finally:
-                if self.session is not None:
-                    await self.close()
+        async def run(query):
+            handle = await self.async_query(**query)
+            return query, await self.retrieve_async(handle=handle, fields=fields, compact=compact)
+
+        async for item in bounded_as_completed((run(q) for q in queries), concurrency):
+            yield item
 
-        return asyncio.run(runner())
     def getIDByCultureno(self, culturecolnumber):
         ''' Initialize search by culture collection number '''
         item = culturecolnumber.strip()
@@ -261,7 +175,7 @@ class bacdive_async(bacdive.BacdiveClient):
         self.url = 'sequence_genome/'+str(item)
         result = self.do_api_call('sequence_genome/'+str(item))
         return result
-    async def async_search(self, **params):
+    async def async_query(self, fields=None, compact=False, cached=True, **params):
         ''' Initialize search with *one* of the following parameters:
         
         id -- BacDive-IDs either as a semicolon seperated string or list
@@ -270,7 +184,13 @@ class bacdive_async(bacdive.BacdiveClient):
         genome -- Genome sequence accession number
         16s -- 16S sequence accession number
         culturecolno -- Culture collection number (mind the space!)
+
+        `fields`/`compact` set the projection used when the handle is retrieved,
+        `cached=False` bypasses the response cache (e.g. to see new hits).
+        Returns a search_result handle and leaves self.url/self.result untouched.
         '''
+        handle = search_result(params)
+        handle.projection = projection_for(fields, compact)
         params = list(params.items())
         allowed = ['id', 'taxonomy', 'sequence',
                    'genome', '16s', 'culturecolno']
@@ -278,21 +198,21 @@ class bacdive_async(bacdive.BacdiveClient):
             print(
                 "ERROR: Exacly one parameter is required. Please choose one of the following:")
             print(", ".join(allowed))
-            return 0
+            return handle
         querytype, query = params[0]
         querytype = querytype.lower()
         if querytype not in allowed:
             print(
                 "ERROR: The given query type is not allowed. Please choose one of the following:")
             print(", ".join(allowed))
-            return 0
+            return handle
         if querytype == 'id':
             if type(query) == type(1):
                 query = str(query)
             if type(query) == type(""):
                 query = query.split(';')
-            self.result = {'count': len(query), 'next': None,
-                           'previous': None, 'results': query}
+            handle.result = {'count': len(query), 'next': None,
+                             'previous': None, 'results': query}
         elif querytype == 'taxonomy':
             if type(query) == type(""):
                 query = [i for i in query.split(" ") if i != "subsp."]
@@ -301,34 +221,104 @@ class bacdive_async(bacdive.BacdiveClient):
                 print(
                     "This query supports only genus, species epithet (optional), and subspecies (optional).")
                 print("They can be defined as list, tuple or string (space separated).")
-                return 0
-            self.result = await self.async_getIDsByTaxonomy(*query)
+                return handle
+            handle.url = self._taxonomy_url(*query)
+            handle.result = await self.do_api_call_async(handle.url, cached)
         elif querytype == 'sequence':
             query = self.parseSearchTypeQuery(query)
-            self.result = await self.async_getIDsByGenome(query)
-            if self.result['count'] == 0:
-                self.result = await self.async_getIDsBy16S(query)
+            handle.url, handle.result = await self._sequence_lookup(query.strip(), cached)
         elif querytype == 'genome':
             query = self.parseSearchTypeQuery(query)
-            self.result = await self.async_getIDsByGenome(query)
+            handle.url = 'sequence_genome/' + query.strip()
+            handle.result = await self.do_api_call_async(handle.url, cached)
         elif querytype == '16s':
             query = self.parseSearchTypeQuery(query)
-            self.result = await self.async_getIDsBy16S(query)
+            handle.url = 'sequence_16s/' + query.strip()
+            handle.result = await self.do_api_call_async(handle.url, cached)
         elif querytype == 'culturecolno':
             query = self.parseSearchTypeQuery(query)
-            self.result = await self.async_getIDByCultureno(query)
+            handle.url = 'culturecollectionno/' + query.strip()
+            handle.result = await self.do_api_call_async(handle.url, cached)
 
-        if not self.result:
+        if not handle.result:
             print("ERROR: Something went wrong. Please check your query and try again")
-            return 0
-        if not 'count' in self.result:
-            print("ERROR:", self.result.get("title"))
-            print(self.result.get("message"))
-            return 0
-        if self.result['count'] == 0:
-            # print("Your search did not receive any results.")
-            return 0
-        return self.result['count']
+        elif not 'count' in handle.result:
+            print("ERROR:", handle.result.get("title"))
+            print(handle.result.get("message"))
+        return handle
+    async def async_search(self, fields=None, compact=False, **params):
+        ''' Initialize search with *one* of the parameters listed in async_query;
+        `fields`/`compact` apply to the following retrieve_async/aiter_records '''
+        handle = await self.async_query(fields, compact, **params)
+        if handle.result is not None:
+            self.url = handle.url
+            self.result = handle.result
+            self.projection = handle.projection
+        return handle.count
+    async def _sequence_lookup(self, query, cached=True):
+        ''' Query the genome and 16S endpoints at once and return (url, result)
+        of the first answer with hits, instead of trying them one after the other.
+        Without hits the 16S answer is returned, as the serial lookup did.
+        '''
+        genome, rrna = 'sequence_genome/' + query, 'sequence_16s/' + query
+        tasks = {asyncio.ensure_future(self.do_api_call_async(url, cached)): url for url in (genome, rrna)}
+        results = {}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    url = tasks[task]
+                    results[url] = task.result()
+                    if isinstance(results[url], dict) and results[url].get('count'):
+                        return url, results[url]
+        finally:
+            # single-flight keeps a request running while another caller still waits for it
+            for task in pending:
+                task.cancel()
+        if isinstance(results[genome], dict) and results[genome].get('count') == 0:
+            return rrna, results[rrna]
+        return genome, results[genome]
+
+    async def resolve_accessions(self, accessions, kind='sequence', concurrency=20):
+        ''' Map sequence accessions to BacDive-IDs: {accession: [ids]}.
+
+        `kind` is 'genome', '16s' or 'sequence' (either; both endpoints are
+        queried concurrently). At most `concurrency` lookups run at once and
+        answers are memoized in self.accession_ids, so accessions seen before
+        cost no request. Accessions whose lookup failed map to None.
+        '''
+        if type(accessions) == type(""):
+            accessions = accessions.split(';')
+        accessions = unique(str(a).strip() for a in accessions if str(a).strip())
+        self.session = await self.get_session()
+
+        async def resolve(accession):
+            key = (kind, accession)
+            if key not in self.accession_ids:
+                handle = await self.async_query(**{kind: accession})
+                if not handle.result or 'count' not in handle.result:
+                    return accession, None
+                try:
+                    ids, _ = await self.list_ids_async(handle)
+                except Exception as e:
+                    print(f"Error resolving accession {accession}: {e}")
+                    return accession, None
+                self.accession_ids[key] = ids
+            return accession, self.accession_ids[key]
+
+        resolved = {}
+        async for accession, ids in bounded_as_completed((resolve(a) for a in accessions), concurrency):
+            resolved[accession] = ids
+        return {a: resolved[a] for a in accessions}
+
+    def _taxonomy_url(self, genus, species_epithet=None, subspecies_epithet=None):
+        item = genus.strip()
+        if species_epithet:
+            item += "/" + species_epithet
+            if subspecies_epithet:
+                item += "/" + subspecies_epithet
+        return 'taxon/' + item
     async def async_getIDByCultureno(self, culturecolnumber):
         ''' Initialize search by culture collection number '''
         item = culturecolnumber.strip()
@@ -1,15 +1,27 @@
 # Extend the lpsn client to add multithreaded retrieval
 from keycloak.exceptions import KeycloakAuthenticationError, KeycloakPostError, KeycloakConnectionError
 import json
-import aiohttp
-import asyncio
 import lpsn
-class lpsn_async(lpsn.LpsnClient):
-    def __init__(self, user, password, public=True, max_retries=10, retry_delay=50, request_timeout=300, config=None):
-        super().__init__(user, password, public, max_retries, retry_delay, request_timeout)
-        self.session = None
+from .client import dsmz_async
+from .streaming import bounded_as_completed
+from . import auth
+from .search import search_result
+from .projection import projection_for
+class lpsn_async(dsmz_async, lpsn.LpsnClient):
+    source = 'lpsn'
+    client_id = "api.lpsn.public"
+    base_urls = {True: "https://api.lpsn.dsmz.de/", False: "http://api.pnu-dev.dsmz.local/"}
+    limits = {'initial': 20, 'maximum': 50}
+    connections = 50
+
+    def __init__(self, user, password, public=True, max_retries=10, retry_delay=50, request_timeout=300, config=None, cache=None, record_cache=None, sso_url=None, api_url=None):
+        if sso_url is None:
+            super().__init__(user, password, public, max_retries, retry_delay, request_timeout)
+        else:
+            self._authenticate(user, password, public, max_retries, retry_delay, request_timeout, sso_url)
         self.config = config
-        self.conn = None
+        self._setup(cache, record_cache, api_url)
+        self._remember_login(user, password)
 
     def search(self, **params):
         ''' Initialize search with parameters
@@ -52,12 +64,31 @@ class lpsn_async(lpsn.LpsnClient):
             return 0
             
         return self.result['count']
+    @classmethod
+    async def create(cls, user=None, password=None, public=True, max_retries=10, retry_delay=50, request_timeout=300, config=None, cache=None, record_cache=None, sso_url=None, api_url=None, session=None, tokens=None):
+        ''' Build and authenticate a client without blocking the event loop.
+
+        Authentication and token refreshes go through the client's aiohttp
+        session, the same one used for the API calls. Pass the `session`
+        and/or `tokens` of another client to share them (no credentials are
+        needed then); a shared session stays open until its owner closes it.
+        Raises the Keycloak exception if the login fails. Use as
+        `async with await lpsn_async.create(user, password) as client:`.
+        '''
+        self = cls.__new__(cls)
+        self._configure(public, max_retries, retry_delay, request_timeout, sso_url or auth.SSO_URLS[public])
+        self.config = config
+        self._setup(cache, record_cache, api_url, session, tokens)
+        return await self._login_async(user, password, tokens)
+
     def do_api_call(self, url):
         ''' Initialize API call on given URL and returns result as json '''
         if self.public:
             baseurl = "https://api.lpsn.dsmz.de/"
         else:
             baseurl = "http://api.pnu-dev.dsmz.local/"
+        if self.api_url:
+            baseurl = self.api_url
         
         if not url.startswith("http"):
             # if base is missing add default:
@@ -115,128 +146,86 @@ class lpsn_async(lpsn.LpsnClient):
             
         return self.result['count']
 
-    async def get_session(self):
-        if self.conn is None:
-            self.conn = aiohttp.TCPConnector(limit=50)
-        if self.session is None:
-            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60), connector=self.conn)
-        return self.session
-    async def refresh_tokens(self):
-        try:
-            token = self.keycloak_openid.refresh_token(self.refresh_token)
-            self.access_token = token['access_token']
-            self.refresh_token = token['refresh_token']
-        except (KeycloakAuthenticationError, KeycloakPostError, KeycloakConnectionError) as e:
-            raise e
+    def _records_of(self, result):
+        ''' {id: record} of a fetch/ response, None if it failed '''
+        fetched = result.get('results') if isinstance(result, dict) else None
+        if not isinstance(fetched, list):
+            return None
+        return {str(el['id']): el for el in fetched}
 
-    async def close(self):
-        await self.session.close()
-        await self.conn.close()
-        self.session = None
-        self.conn = None
-        
-    async def do_request_async(self, url):
-        """Async HTTP GET with retry + token auth"""
-        headers = {
-            "Accept": "application/json",
-            "Authorization": f"Bearer {self.access_token}"
-        }
-        try:
-            self.session = await self.get_session()
-        except Exception as e:
-            print(f"Error getting session: {e}")
-            return {}, {}
-        timeout = aiohttp.ClientTimeout(total=self.request_timeout)
-        for attempt in range(1, self.max_retries + 1):
-            try:
-                async with self.session.get(url, headers=headers, timeout=timeout) as resp:
-                    if resp.status == 401:
-                        # refresh token
-                        await self.refresh_tokens()
-                        continue
-                    
-                    if resp.status in [429, 500, 502, 503, 504]:
-                        # Retryable errors
-                        await asyncio.sleep(2 ** attempt)
-                        continue
-
-                    # Return JSON for non-error statuses
-                    data = await resp.json()
-                    return resp, data
-
-            except aiohttp.ClientError as e:
-                await self.refresh_tokens()
-                await asyncio.sleep(2 ** attempt)
-                print(f"Retrying {url}, attempt {attempt}")
-                
-
-        raise RuntimeError(f"Failed to GET {url} after {self.max_retries} retries")
-    async def do_api_call_async(self, url):
-        baseurl = (
-            "https://api.lpsn.dsmz.de/" if self.public else "http://api.pnu-dev.dsmz.local/"
-        )
-        if not url.startswith("http"):
-            url = baseurl + url
+    async def _entries_from_result(self, result):
+        ''' Turn a listing response into entries, fetching them if only IDs were returned '''
+        ids, entries = self._split_results(result)
+        if ids:
+            return await self.fetch_entries_async(ids)
+        return entries
 
-        resp, data = await self.do_request_async(url)
-        if resp.status in (500, 400, 503):
-            print(f"Error {resp.status}: {data}")
-            return data
-        elif (resp.status == 401):
-            # Access token might have expired (15 minutes life time).
-            # Get new tokens using refresh token and try again.
-        
-            token = await self.refresh_tokens()
-            self.access_token = token['access_token']
-            self.refresh_token = token['refresh_token']
-            return await self.do_api_call_async(url)
-        return data
-    
     async def parse_entries_async(self, url):
         result = await self.do_api_call_async(url)
         try:
-            if result.get('results') == []:
-                return []
-            if type(result.get('results')[0]) != int:
-                return [el for el in result['results']]
-            ids = ";".join(str(i) for i in result['results'])
-            entries = await self.do_api_call_async(f"fetch/{ids}")
-            return [el for el in entries['results']]
+            return await self._entries_from_result(result)
         except Exception as e:
             print(f"Error parsing entries from {url}: {e}")
             return []
 
-    
-    async def retrieve_async(self):
-        self.session = await self.get_session()  # temporarily assign for internal methods
-        # print(self.url)
-        num_jobs = max(0, (self.result['count'] - 1) // 100)
-        # prepare URLs for all pages
-        # if &not=yes is in the URL, we need to keep it at the end
+    def _page_urls(self, url, count):
+        ''' Build the listing URLs for every page of a search with `count` hits '''
+        num_jobs = max(0, (count - 1) // 100)
         if num_jobs == 0:
-            return await self.parse_entries_async(self.url)
-        if '&not=yes' in self.url:
+            return [url]
+        # if &not=yes is in the URL, we need to keep it at the end
+        if '&not=yes' in url:
             translation = {'{':'%7B', '}':'%7D', '"':'%22', ' ':'+', ':':'%3A', ',':'%2C', '[':'%5B', ']':'%5D'}
-            base_url = self.url.replace('&not=yes', '').translate(str.maketrans(translation))
-            urls = [f"{base_url}&not=yes&page={i}" for i in range(num_jobs + 1)]
-        else:
-            urls = [f"{self.url}&page={i}" for i in range(num_jobs + 1)] 
-        tasks = [self.parse_entries_async(url) for url in urls]
-        all_results = await asyncio.gather(*tasks)
+            base_url = url.replace('&not=yes', '').translate(str.maketrans(translation))
+            return [f"{base_url}&not=yes&page={i}" for i in range(num_jobs + 1)]
+        return [f"{url}&page={i}" for i in range(num_jobs + 1)]
+
+    async def search_many(self, queries, concurrency=20, flex=False, fields=None, compact=False):
+        ''' Run many searches and yield (query, entries) as each query completes.
+
+        Each query is a dict of async_search parameters, or a flexible search
+        dict if `flex` is set. No instance state is changed.
+        '''
+        self.session = await self.get_session()
 
-        # flatten the results
-        return [item for sublist in all_results for item in sublist]
-    async def async_search(self, **params):
+        async def run(query):
+            if flex:
+                handle = await self.async_flex_query(query)
+            else:
+                handle = await self.async_query(**query)
+            return query, await self.retrieve_async(handle=handle, fields=fields, compact=compact)
+
+        async for item in bounded_as_completed((run(q) for q in queries), concurrency):
+            yield item
+
+    def _check_result(self, handle):
+        if not handle.result:
+            print("ERROR: Something went wrong. Please check your query and try again")
+        elif not 'count' in handle.result:
+            print("ERROR:", handle.result.get("title"))
+            print(handle.result.get("message"))
+        elif handle.result['count'] == 0:
+            print("Your search did not receive any results.")
+        return handle
+
+    async def async_query(self, fields=None, compact=False, cached=True, **params):
+        ''' Run an advanced search (or an id lookup) and return a search_result
+        handle, leaving self.url/self.result untouched. `fields`/`compact` set
+        the projection used when the handle is retrieved, `cached=False`
+        bypasses the response cache (e.g. to see new hits).
+        '''
+        handle = search_result(params)
+        handle.projection = projection_for(fields, compact)
         if 'id' in params:
             query = params['id']
             if type(query) == type(1):
                 query = str(query)
             if type(query) == type(""):
                 query = query.split(';')
-            self.result = {'count': len(query), 'next': None,
-                            'previous': None, 'results': query}
-            self.url = 'fetch/' + ';'.join(query)
-            return self.result['count']
+            handle.result = {'count': len(query), 'next': None,
+                             'previous': None, 'results': query}
+            handle.url = 'fetch/' + ';'.join(query)
+            return handle
 
         query = []
         for k, v in params.items():
@@ -248,58 +237,42 @@ class lpsn_async(lpsn.LpsnClient):
             else:
                 v = str(v)
             query.append(k + "=" + v)
-        self.result = await self.do_api_call_async('advanced_search?'+'&'.join(query))
         # we need to store the URL for later retrieval
-        self.url = 'advanced_search?'+'&'.join(query)
-        if not self.result:
-            print("ERROR: Something went wrong. Please check your query and try again")
-            return 0
-            
-        if not 'count' in self.result:
-            print("ERROR:", self.result.get("title"))
-            print(self.result.get("message"))
-            return 0
-            
-        if self.result['count'] == 0:
-            print("Your search did not receive any results.")
-            return 0
-            
-        return self.result['count']
-    async def async_flex_search(self, search, negate=False):
-        ''' Initialize flexible search with parameters
+        handle.url = 'advanced_search?'+'&'.join(query)
+        handle.result = await self.do_api_call_async(handle.url, cached)
+        return self._check_result(handle)
+
+    async def async_search(self, fields=None, compact=False, **params):
+        handle = await self.async_query(fields, compact, **params)
+        self.url = handle.url
+        self.result = handle.result
+        self.projection = handle.projection
+        return handle.count
+    async def async_flex_query(self, search, negate=False, fields=None, compact=False, cached=True):
+        ''' Run a flexible search and return a search_result handle,
+        leaving self.url/self.result untouched.
         '''
-       
+        handle = search_result(search)
+        handle.projection = projection_for(fields, compact)
         if not search:
             print("You must enter search parameters.")
-            return 0
+            return handle
         
         param_str = '?search='+json.dumps(search)
         if negate:
             param_str += '&not=yes'
 
-        self.result = await self.do_api_call_async('flexible_search'+param_str)
         # we need to store the URL for later retrieval
-        self.url = 'flexible_search'+param_str
-        if not self.result:
-            print("ERROR: Something went wrong. Please check your query and try again")
-            return 0
-            
-        if not 'count' in self.result:
-            print("ERROR:", self.result.get("title"))
-            print(self.result.get("message"))
-            return 0
-            
-        if self.result['count'] == 0:
-            print("Your search did not receive any results.")
-            return 0
-            
-        return self.result['count']
-    def retrieve(self):
-        async def runner():
-            try:
-                return await self.retrieve_async()
-            finally:
-                if self.session is not None:
-                    await self.close()
+        handle.url = 'flexible_search'+param_str
+        handle.result = await self.do_api_call_async(handle.url, cached)
+        return self._check_result(handle)
 
-        return asyncio.run(runner())
+    async def async_flex_search(self, search, negate=False, fields=None, compact=False):
+        ''' Initialize flexible search with parameters
+        '''
+        handle = await self.async_flex_query(search, negate, fields, compact)
+        if handle.result is not None:
+            self.url = handle.url
+            self.result = handle.result
+            self.projection = handle.projection
+        return handle.count
@@ -0,0 +1,42 @@
+# Keycloak authentication over aiohttp, for building clients without blocking the loop
+from keycloak.exceptions import KeycloakAuthenticationError, KeycloakPostError, KeycloakConnectionError
+import aiohttp
+
+# Keycloak servers used by the bacdive and lpsn packages
+SSO_URLS = {
+    True: "https://sso.dsmz.de/auth/",
+    False: "https://sso.dmz.dsmz.de/auth/",
+}
+REALM = "dsmz"
+
+
+def token_url(sso_url, realm=REALM):
+    return f"{sso_url.rstrip('/')}/realms/{realm}/protocol/openid-connect/token"
+
+
+async def request_token(session, sso_url, client_id, data, realm=REALM):
+    ''' POST a grant to the Keycloak token endpoint and return the token dict.
+
+    Raises the python-keycloak exceptions the sync clients raise, so callers
+    can handle both paths alike.
+    '''
+    try:
+        async with session.post(token_url(sso_url, realm), data={'client_id': client_id, **data}) as resp:
+            body = await resp.read()
+            if resp.status in (400, 401):
+                raise KeycloakAuthenticationError(error_message=body, response_code=resp.status)
+            if resp.status != 200:
+                raise KeycloakPostError(error_message=body, response_code=resp.status)
+            return await resp.json(content_type=None)
+    except aiohttp.ClientError as e:
+        raise KeycloakConnectionError(f"Can't connect to server ({e})") from e
+
+
+async def password_token(session, sso_url, client_id, user, password, realm=REALM):
+    return await request_token(session, sso_url, client_id,
+                               {'grant_type': 'password', 'username': user, 'password': password}, realm)
+
+
+async def refresh_token(session, sso_url, client_id, token, realm=REALM):
+    return await request_token(session, sso_url, client_id,
+                               {'grant_type': 'refresh_token', 'refresh_token': token}, realm)
@@ -0,0 +1,104 @@
+# A persistent event loop in a background thread for the blocking entry points
+import asyncio
+import atexit
+import threading
+import weakref
+
+
+class background_loop:
+    ''' An event loop running forever in a daemon thread.
+
+    Coroutines given to run() execute on that loop while the calling thread
+    blocks for the result, so client sessions, connection pools and tokens
+    stay alive from one call to the next. This works from scripts, from
+    several threads at once (e.g. web workers) and from code that already
+    runs a loop such as Jupyter, where asyncio.run() is refused.
+    '''
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self._lock = threading.Lock()
+        # clients whose sessions live on this loop, closed by stop()
+        self._clients = weakref.WeakSet()
+
+    def start(self):
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def serve():
+                    asyncio.set_event_loop(self.loop)
+                    self.loop.call_soon(ready.set)
+                    self.loop.run_forever()
+
+                self.thread = threading.Thread(target=serve, name="async_dsmz-loop", daemon=True)
+                self.thread.start()
+                ready.wait()
+        return self
+
+    def track(self, client):
+        ''' Close `client` when the loop stops '''
+        self._clients.add(client)
+        return self
+
+    def run(self, coro, timeout=None):
+        ''' Run `coro` on the background loop and return its result '''
+        self.start()
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("Cannot block on the background loop from a coroutine running on it, await instead")
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            # timeout or KeyboardInterrupt: do not leave the call running
+            future.cancel()
+            raise
+
+    def iterate(self, records):
+        ''' Iterate an async iterable (e.g. aiter_records()) from blocking code '''
+        iterator = records.__aiter__()
+
+        async def next_item():
+            return await iterator.__anext__()
+
+        try:
+            while True:
+                try:
+                    item = self.run(next_item())
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            if hasattr(iterator, 'aclose'):
+                self.run(iterator.aclose())
+
+    def stop(self):
+        if self.thread is None or not self.thread.is_alive():
+            return
+        for client in list(self._clients):
+            if client.session is not None:
+                try:
+                    self.run(client.close(), timeout=10)
+                except Exception as e:
+                    print(f"Error closing client session: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.thread = None
+        self.loop = None
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_loop():
+    ''' The process-wide background_loop, started on first use and stopped at exit '''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = background_loop()
+            atexit.register(_shared.stop)
+    return _shared.start()
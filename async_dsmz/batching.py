@@ -0,0 +1,107 @@
+# Repacking of listing page IDs into full fetch/ batches
+import asyncio
+
+# the DSMZ APIs accept at most this many IDs per fetch/ call
+MAX_FETCH_IDS = 100
+
+
+def chunked(ids, size=MAX_FETCH_IDS):
+    ''' Split a list of IDs into lists of at most `size` IDs '''
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+def unique(ids):
+    ''' Drop repeated IDs while keeping the first-seen order '''
+    seen = set()
+    return [i for i in (str(i) for i in ids) if not (i in seen or seen.add(i))]
+
+
+class id_batcher:
+    ''' Collect IDs from any number of listing pages into deduplicated batches
+    of exactly `size` IDs, independent of where the page boundaries fall.
+    '''
+    def __init__(self, size=MAX_FETCH_IDS):
+        self.size = size
+        self._seen = set()
+        self._pending = []
+
+    def add(self, ids):
+        ''' Add IDs and return every batch that is now full '''
+        for i in ids:
+            i = str(i)
+            if i not in self._seen:
+                self._seen.add(i)
+                self._pending.append(i)
+        full = len(self._pending) - len(self._pending) % self.size
+        batches = chunked(self._pending[:full], self.size)
+        self._pending = self._pending[full:]
+        return batches
+
+    def flush(self):
+        ''' Return the last, partially filled batch (if any) '''
+        batches = [self._pending] if self._pending else []
+        self._pending = []
+        return batches
+
+
+_DONE = object()
+
+
+async def packed_entries(list_page, fetch_batch, urls, ids=(), listing_workers=10, fetch_workers=20,
+                         size=MAX_FETCH_IDS):
+    ''' Yield lists of entries for a search whose IDs come from listing pages.
+
+    `list_page(url)` returns (ids, entries) for one listing page, where entries
+    are records the server already returned inline. Listing workers push the
+    IDs of every page (after the optional seed `ids`) through an id_batcher
+    into a queue of full batches, which fetch workers drain with
+    `fetch_batch(batch)`. Fetching therefore starts as soon as the first IDs
+    are known while other pages are still being listed. Both queues are
+    bounded, so a slow consumer holds back the workers.
+    '''
+    batcher = id_batcher(size)
+    urls = iter(urls)
+    batches = asyncio.Queue(maxsize=2 * fetch_workers)
+    results = asyncio.Queue(maxsize=fetch_workers)
+
+    async def lister():
+        for url in urls:
+            page_ids, entries = await list_page(url)
+            if entries:
+                await results.put(entries)
+            for batch in batcher.add(page_ids):
+                await batches.put(batch)
+
+    async def fetcher():
+        while (batch := await batches.get()) is not None:
+            await results.put(await fetch_batch(batch))
+
+    listers = [asyncio.ensure_future(lister()) for _ in range(listing_workers)]
+    fetchers = [asyncio.ensure_future(fetcher()) for _ in range(fetch_workers)]
+
+    async def produce():
+        for batch in batcher.add(ids):
+            await batches.put(batch)
+        await asyncio.gather(*listers)
+        for batch in batcher.flush():
+            await batches.put(batch)
+        for _ in range(fetch_workers):
+            await batches.put(None)
+
+    async def run():
+        try:
+            await asyncio.gather(produce(), *fetchers)
+        except Exception as e:
+            await results.put(e)
+            return
+        await results.put(_DONE)
+
+    pipeline = asyncio.ensure_future(run())
+    try:
+        while (item := await results.get()) is not _DONE:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        for task in [pipeline] + listers + fetchers:
+            task.cancel()
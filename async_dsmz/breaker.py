@@ -0,0 +1,97 @@
+# Per-host circuit breaker and hedged requests for bounding tail latency
+import asyncio
+import time
+import weakref
+
+# statuses that say the host itself is unavailable, unlike a 500 of a single URL
+HOST_FAILURES = (502, 503, 504)
+
+
+class circuit_breaker:
+    ''' Fail fast while a host is down instead of retrying against it.
+
+    After `failures` consecutive failed requests (connection errors,
+    timeouts, HOST_FAILURES) the circuit opens and requests are refused for
+    `reset_after` seconds. Then one probe request at a time is let through
+    (half-open) until one succeeds and closes the circuit again.
+    '''
+    def __init__(self, failures=5, reset_after=30):
+        self.threshold = failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_after:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        ''' Whether a request may be sent now '''
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'open' or self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        ''' The request ended without telling anything about the host (cancelled, throttled) '''
+        self._probing = False
+
+
+# event loop -> {host: circuit breaker}, its waiters and timers only work on their own loop
+_breakers = weakref.WeakKeyDictionary()
+
+
+def breaker_for(host, **defaults):
+    ''' Return the circuit breaker shared by every client of the running loop talking to `host` '''
+    hosts = _breakers.setdefault(asyncio.get_running_loop(), {})
+    if host not in hosts:
+        hosts[host] = circuit_breaker(**defaults)
+    return hosts[host]
+
+
+async def hedged(call, delay, on_hedge=None):
+    ''' Await `call()`, starting a second identical call if the first has not
+    finished after `delay` seconds, and return whichever succeeds first.
+
+    The slower call is cancelled. Only use it for idempotent requests.
+    `on_hedge(won)` is told that a hedge was sent and whether it won.
+    '''
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.append(asyncio.ensure_future(call()))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if on_hedge is not None and len(tasks) > 1:
+                        on_hedge(task is tasks[1])
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,177 @@
+# Persistent caching of DSMZ API responses
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import json
+import sqlite3
+import threading
+import time
+
+# seconds a cached response stays valid, per endpoint (first path segment)
+DEFAULT_TTL = {
+    'fetch': 7 * 24 * 3600,
+    None: 24 * 3600,
+}
+
+
+def normalize_url(url):
+    ''' Normalize a request URL so equivalent requests share a cache key '''
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if k != 'predictions')
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path,
+                       urlencode(query), ''))
+
+
+def endpoint_of(url):
+    ''' Return the endpoint name (e.g. fetch, taxon, advanced_search) of a URL '''
+    return urlsplit(url).path.strip('/').split('/')[0]
+
+
+class response_cache:
+    ''' SQLite backed cache of decoded API responses.
+
+    Entries are keyed by the normalized URL plus the predictions flag, expire
+    after a per-endpoint TTL and are evicted least-recently-used once the
+    stored bodies exceed `max_bytes`. In `offline` mode the clients answer from
+    the cache only and never touch the network.
+    '''
+    def __init__(self, path="async_dsmz_cache.sqlite", ttl=None, max_bytes=1024 ** 3, offline=False):
+        self.path = path
+        if ttl is None:
+            ttl = DEFAULT_TTL
+        elif not isinstance(ttl, dict):
+            ttl = {None: ttl}
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, endpoint TEXT, stored REAL, accessed REAL,
+            size INTEGER, body BLOB)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._db.commit()
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def key(self, url, predictions=False):
+        return f"{normalize_url(url)}#predictions={int(bool(predictions))}"
+
+    def ttl_for(self, endpoint):
+        return self.ttl.get(endpoint, self.ttl.get(None))
+
+    def get(self, url, predictions=False):
+        ''' Return the cached response for `url` or None if missing or expired '''
+        key = self.key(url, predictions)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT endpoint, stored, size, body FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            endpoint, stored, size, body = row
+            ttl = self.ttl_for(endpoint)
+            if ttl is not None and now - stored > ttl and not self.offline:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._db.commit()
+                self._size -= size
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(body)
+
+    def set(self, url, predictions, data):
+        ''' Store a decoded response and evict old entries if the cache is full '''
+        key = self.key(url, predictions)
+        body = json.dumps(data).encode()
+        now = time.time()
+        with self._lock:
+            old = self._db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                self._size -= old[0]
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, endpoint_of(url), now, now, len(body), body))
+            self._size += len(body)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # drop least recently used entries until we are back under the size limit
+        while self._size > self.max_bytes:
+            rows = self._db.execute(
+                'SELECT key, size FROM responses ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                self._size = 0
+                break
+            for key, size in rows:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._size -= size
+                if self._size <= self.max_bytes:
+                    break
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._db.commit()
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class record_cache:
+    ''' SQLite backed cache of single BacDive/LPSN records keyed by their ID.
+
+    Lets the clients split a batch of IDs into cached hits and misses so that
+    `fetch/` is only called for records that have not been seen recently.
+    '''
+    def __init__(self, path="async_dsmz_cache.sqlite", ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS records (
+            key TEXT PRIMARY KEY, stored REAL, body BLOB)''')
+        self._db.commit()
+
+    def key(self, source, record_id, predictions=False):
+        return f"{source}:{record_id}#predictions={int(bool(predictions))}"
+
+    def get_many(self, source, ids, predictions=False):
+        ''' Return a dict of the cached, unexpired records among `ids` '''
+        found = {}
+        oldest = time.time() - self.ttl if self.ttl is not None else None
+        with self._lock:
+            for record_id in ids:
+                row = self._db.execute('SELECT stored, body FROM records WHERE key = ?',
+                                       (self.key(source, record_id, predictions),)).fetchone()
+                if row is None or (oldest is not None and row[0] < oldest):
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                found[str(record_id)] = json.loads(row[1])
+        return found
+
+    def set_many(self, source, records, predictions=False):
+        ''' Store a dict of records keyed by their ID '''
+        now = time.time()
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?)', [
+                (self.key(source, record_id, predictions), now, json.dumps(record).encode())
+                for record_id, record in records.items()])
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM records')
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
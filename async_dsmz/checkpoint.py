@@ -0,0 +1,175 @@
+# Resumable bulk retrieval backed by a local checkpoint file
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+from .batching import MAX_FETCH_IDS, chunked, unique
+from .streaming import bounded_as_completed
+
+# SQLite limits the number of host parameters per statement
+_SQL_CHUNK = 500
+
+
+def search_key(url, count, ids=()):
+    ''' Identify a search, so a checkpoint is never resumed for another one '''
+    if url is not None:
+        return json.dumps([url, count])
+    return 'ids:' + hashlib.sha1(';'.join(str(i) for i in ids).encode()).hexdigest()
+
+
+class retrieval_checkpoint:
+    ''' SQLite file recording the progress of one bulk retrieval.
+
+    Listing pages are stored with their IDs once they succeed and records as
+    soon as their fetch/ batch returns. Pages and batches that still fail
+    after the client's retries are kept with their error, and running the
+    same retrieval again with this checkpoint only repeats the missing work.
+    '''
+    def __init__(self, path="async_dsmz_checkpoint.sqlite"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS pages (
+            url TEXT PRIMARY KEY, ids TEXT, error TEXT)''')
+        self._db.execute('CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, body TEXT)')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS batches (
+            first TEXT PRIMARY KEY, ids TEXT, error TEXT)''')
+        self._db.commit()
+
+    def begin(self, key):
+        ''' Claim the checkpoint for search `key`; raises ValueError if it belongs to another search '''
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'search'").fetchone()
+            if row is None:
+                self._db.execute("INSERT INTO meta VALUES ('search', ?)", (key,))
+                self._db.commit()
+            elif row[0] != key:
+                raise ValueError(f"Checkpoint {self.path} belongs to another search: {row[0]}")
+
+    def completed_pages(self):
+        ''' Return {url: ids} for every listing page that has been retrieved '''
+        with self._lock:
+            rows = self._db.execute('SELECT url, ids FROM pages WHERE error IS NULL').fetchall()
+        return {url: json.loads(ids) for url, ids in rows}
+
+    def page_done(self, url, ids, records=None):
+        ''' Store the IDs of a listing page together with any records it returned inline '''
+        with self._lock:
+            if records:
+                self._db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?)',
+                                     [(str(k), json.dumps(v)) for k, v in records.items()])
+            self._db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, NULL)', (url, json.dumps(ids)))
+            self._db.commit()
+
+    def page_failed(self, url, error):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO pages VALUES (?, NULL, ?)', (url, str(error)))
+            self._db.commit()
+
+    def stored_ids(self):
+        with self._lock:
+            return {row[0] for row in self._db.execute('SELECT id FROM records')}
+
+    def batch_done(self, ids, records):
+        ''' Store the records of a fetch/ batch and forget an earlier failure of it '''
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?)',
+                                 [(str(k), json.dumps(v)) for k, v in records.items()])
+            self._db.execute('DELETE FROM batches WHERE first = ?', (ids[0],))
+            self._db.commit()
+
+    def batch_failed(self, ids, error):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO batches VALUES (?, ?, ?)',
+                             (ids[0], json.dumps(ids), str(error)))
+            self._db.commit()
+
+    def forget_batches(self):
+        ''' Drop recorded batch failures; the missing IDs are batched anew on every run '''
+        with self._lock:
+            self._db.execute('DELETE FROM batches')
+            self._db.commit()
+
+    def records(self, ids):
+        ''' Return the stored records for `ids` in the given order '''
+        found = {}
+        with self._lock:
+            for part in chunked(list(ids), _SQL_CHUNK):
+                rows = self._db.execute(
+                    f"SELECT id, body FROM records WHERE id IN ({','.join('?' * len(part))})", part)
+                found.update((i, json.loads(body)) for i, body in rows)
+        return [found[i] for i in ids if i in found]
+
+    def failed_pages(self):
+        ''' Return {url: error} for listing pages that could not be retrieved '''
+        with self._lock:
+            return dict(self._db.execute('SELECT url, error FROM pages WHERE error IS NOT NULL'))
+
+    def failed_batches(self):
+        ''' Return [(ids, error)] for fetch/ batches that could not be retrieved '''
+        with self._lock:
+            rows = self._db.execute('SELECT ids, error FROM batches').fetchall()
+        return [(json.loads(ids), error) for ids, error in rows]
+
+    def clear(self):
+        with self._lock:
+            for table in ('meta', 'pages', 'records', 'batches'):
+                self._db.execute(f'DELETE FROM {table}')
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+async def checkpointed_entries(checkpoint, key, list_page, fetch_batch, urls, ids=(),
+                               listing_workers=10, fetch_workers=20, size=MAX_FETCH_IDS, known=None):
+    ''' Retrieve every entry of a search, resuming from `checkpoint`.
+
+    `list_page(url)` returns (ids, {id: entry}) for one listing page and
+    `fetch_batch(ids)` returns {id: entry}; both must raise on failure rather
+    than return an empty result. Pages already in the checkpoint are not listed
+    again and IDs whose records are stored are not fetched again. Returns the
+    entries in listing order; failures are left in the checkpoint.
+    `known` holds pages already downloaded, {url: (ids, {id: entry})}, which
+    are stored without listing them again.
+    '''
+    await asyncio.to_thread(checkpoint.begin, key)
+    done = await asyncio.to_thread(checkpoint.completed_pages)
+    for url, (page_ids, inline) in (known or {}).items():
+        if url not in done:
+            page_ids = list(page_ids) + [str(i) for i in inline]
+            await asyncio.to_thread(checkpoint.page_done, url, page_ids, inline)
+            done[url] = page_ids
+
+    async def list_one(url):
+        try:
+            page_ids, inline = await list_page(url)
+        except Exception as e:
+            await asyncio.to_thread(checkpoint.page_failed, url, e)
+            return
+        page_ids = list(page_ids) + [str(i) for i in inline]
+        await asyncio.to_thread(checkpoint.page_done, url, page_ids, inline)
+        done[url] = page_ids
+
+    async for _ in bounded_as_completed((list_one(u) for u in urls if u not in done), listing_workers):
+        pass
+
+    order = unique(list(ids) + [i for u in urls if u in done for i in done[u]])
+    stored = await asyncio.to_thread(checkpoint.stored_ids)
+    missing = [i for i in order if i not in stored]
+    await asyncio.to_thread(checkpoint.forget_batches)
+
+    async def fetch_one(batch):
+        try:
+            records = await fetch_batch(batch)
+        except Exception as e:
+            await asyncio.to_thread(checkpoint.batch_failed, batch, e)
+            return
+        await asyncio.to_thread(checkpoint.batch_done, batch, records)
+
+    async for _ in bounded_as_completed((fetch_one(b) for b in chunked(missing, size)), fetch_workers):
+        pass
+    return await asyncio.to_thread(checkpoint.records, order)
@@ -0,0 +1,722 @@
+# Request, retrieval and streaming machinery shared by bacdive_async and lpsn_async
+from keycloak.exceptions import KeycloakAuthenticationError, KeycloakPostError, KeycloakConnectionError
+from keycloak import KeycloakOpenID
+import aiohttp
+import asyncio
+import time
+from contextlib import aclosing
+from functools import partial
+from urllib.parse import urlsplit
+from .streaming import bounded_as_completed
+from .tokens import token_manager
+from .background import shared_loop
+from . import auth
+from .search import search_result
+from .decoding import json_decoder
+from .cache import endpoint_of, normalize_url
+from .singleflight import single_flight
+from .metrics import metrics_recorder, retrieval_summary, current_summary, trace_config
+from .batching import chunked, unique, packed_entries
+from .checkpoint import retrieval_checkpoint, checkpointed_entries, search_key
+from .export import export_async
+from .projection import projection_for
+from .breaker import HOST_FAILURES, breaker_for, hedged
+from .limiter import limiter_for, backoff_delay, parse_retry_after, RETRYABLE, THROTTLED
+
+
+class attempt_failed(Exception):
+    ''' A GET attempt that returned no data: its status, the server's
+    Retry-After and whether the access token had expired '''
+    def __init__(self, status, retry_after=None, expired=False):
+        super().__init__(f"GET failed: {status}")
+        self.status = status
+        self.retry_after = retry_after
+        self.expired = expired
+
+
+class dsmz_async:
+    ''' Mixin with the async machinery of the DSMZ API clients.
+
+    bacdive_async and lpsn_async put it in front of the synchronous client of
+    their API and only fill in what differs between the two:
+
+    source -- API name used for metrics and the record cache
+    client_id -- Keycloak client of the API
+    base_urls -- {public: API base URL}
+    limits -- initial and maximum concurrency of the host's adaptive_limiter
+    connections -- size of the client's connection pool
+    _page_urls(url, count) -- listing URLs of every page of a search
+    _records_of(result) -- {id: record} of a fetch/ response, None if it failed
+    '''
+    source = None
+    client_id = None
+    base_urls = {}
+    limits = {'initial': 20, 'maximum': 50}
+    connections = 50
+    predictions = False
+
+    def _configure(self, public, max_retries, retry_delay, request_timeout, sso_url):
+        self.result = {}
+        self.public = public
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay # in seconds
+        self.request_timeout = request_timeout # in seconds
+        self.sso_url = sso_url
+        # constructing KeycloakOpenID makes no request, it only serves the sync methods
+        self.keycloak_openid = KeycloakOpenID(
+            server_url=sso_url,
+            client_id=self.client_id,
+            realm_name="dsmz")
+
+    def _authenticate(self, user, password, public, max_retries, retry_delay, request_timeout, sso_url):
+        ''' Same setup as the sync client's __init__ but against the Keycloak server at `sso_url` '''
+        self._configure(public, max_retries, retry_delay, request_timeout, sso_url)
+        token = self.keycloak_openid.token(user, password)
+        self.access_token = token['access_token']
+        self.refresh_token = token['refresh_token']
+
+    def _setup(self, cache, record_cache, api_url, session=None, tokens=None):
+        ''' Client state shared by __init__ and create() '''
+        # override the API base URL, e.g. to point the client at mock_server
+        self.api_url = api_url
+        self.session = session
+        # a session passed in belongs to the caller and is not closed by close()
+        self._owns_session = session is None
+        self.conn = session.connector if session is not None else None
+        self._lock = asyncio.Lock()
+        # loop the session belongs to, set by the first get_session()
+        self._session_loop = None
+        # None uses the adaptive limiter shared by all clients of the same host
+        self.limiter = None
+        # None uses the circuit breaker shared by all clients of the same host
+        self.breaker = None
+        # seconds to connect and between two reads; request_timeout bounds a whole request
+        self.connect_timeout = 10
+        self.read_timeout = 60
+        # send a second GET when a request takes longer than the host's p95
+        # latency (or hedge_delay seconds) and keep whichever answers first
+        self.hedge = False
+        self.hedge_delay = None
+        self.cache = cache
+        self.record_cache = record_cache
+        # projection of the current search, set by async_search(fields=...)
+        self.projection = None
+        self.decoder = json_decoder()
+        # set metrics.sink to a memory_sink, prometheus_sink or otel_sink to export metrics
+        self.metrics = metrics_recorder(self.source)
+        self.last_summary = None
+        if tokens is None:
+            tokens = token_manager(self.keycloak_openid, getattr(self, 'access_token', None),
+                                   getattr(self, 'refresh_token', None))
+            tokens.on_refresh = self.metrics.token_refresh
+        # may be shared with other clients, see create(tokens=...)
+        self.tokens = tokens
+        # identical concurrent API calls share one request
+        self.inflight = single_flight()
+        self.inflight.on_shared = self.metrics.deduplicated
+
+    async def _login_async(self, user, password, tokens=None):
+        ''' Second half of create(): log in, or take over the shared `tokens` '''
+        if tokens is not None:
+            self.access_token = tokens.access_token
+            self.refresh_token = tokens.refresh_token
+            return self
+        try:
+            await self._authenticate_async(user, password)
+        except BaseException:
+            # do not leave the session of a client nobody gets to close
+            await self.close()
+            raise
+        return self
+
+    async def _authenticate_async(self, user, password):
+        ''' Log in over the client session, retrying like the sync client does '''
+        for attempt in range(self.max_retries):
+            try:
+                token = await self._password_token_async(user, password)
+                break
+            except KeycloakAuthenticationError:
+                print("ERROR: Authentication failed. Please check your credentials.")
+                raise
+            except (KeycloakPostError, KeycloakConnectionError) as e:
+                print(f"Authentication attempt {attempt + 1} failed: {e}")
+                if attempt + 1 >= self.max_retries:
+                    print(f"ERROR: Authentication failed after {self.max_retries} attempts.")
+                    raise
+                await asyncio.sleep(self.retry_delay)
+        self.access_token = token['access_token']
+        self.refresh_token = token['refresh_token']
+        self.tokens.access_token = self.access_token
+        self.tokens.refresh_token = self.refresh_token
+        self.tokens.refresh_call = self._refresh_call_async
+        self._remember_login(user, password)
+
+    def _remember_login(self, user, password):
+        ''' Let the token manager log in again once the refresh token has expired too '''
+        if self.tokens.refresh_call is None:
+            # like the refreshes of a client built by __init__, in a worker thread
+            self.tokens.login_call = partial(asyncio.to_thread, self.keycloak_openid.token, user, password)
+        else:
+            self.tokens.login_call = partial(self._password_token_async, user, password)
+
+    async def _password_token_async(self, user, password):
+        session = await self.get_session()
+        return await auth.password_token(session, self.sso_url, self.keycloak_openid.client_id, user, password)
+
+    async def _refresh_call_async(self, refresh_token):
+        session = await self.get_session()
+        return await auth.refresh_token(session, self.sso_url, self.keycloak_openid.client_id, refresh_token)
+
+    async def __aenter__(self):
+        await self.get_session()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def get_session(self):
+        loop = asyncio.get_running_loop()
+        if self._session_loop is None:
+            self._session_loop = loop
+        elif self._session_loop is not loop:
+            # a session only works on the loop it was made on, e.g. retrieve()
+            # runs on the background loop and asyncio.run() on a loop of its own
+            self._release_session()
+            self._session_loop = loop
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.conn is None:
+                self.conn = aiohttp.TCPConnector(limit=self.connections)
+            if self.session is None:
+                self.session = aiohttp.ClientSession(
+                    timeout=self._timeout(),
+                    connector=self.conn,
+                    trace_configs=[trace_config(self.metrics)]
+                )
+            return self.session
+
+    async def refresh_tokens(self, stale=None):
+        ''' Refresh tokens off the event loop, sharing one refresh between concurrent callers '''
+        try:
+            token = await self.tokens.refresh(stale)
+        except (KeycloakAuthenticationError, KeycloakPostError, KeycloakConnectionError) as e:
+            raise e
+        self.access_token = self.tokens.access_token
+        self.refresh_token = self.tokens.refresh_token
+        return token
+
+    def _release_session(self):
+        ''' Drop the session of another loop, closing it there if that loop still runs '''
+        loop = self._session_loop
+        if self._owns_session and loop.is_running():
+            for closable in (self.session, self.conn):
+                if closable is not None:
+                    asyncio.run_coroutine_threadsafe(closable.close(), loop)
+        self.session = None
+        self.conn = None
+        # the next session is made by get_session(), so it is ours to close
+        self._owns_session = True
+
+    async def close(self):
+        # requests still in flight would only run into the closed session
+        self.inflight.cancel()
+        if self._session_loop not in (None, asyncio.get_running_loop()):
+            self._release_session()
+        elif self._owns_session:
+            if self.session is not None:
+                await self.session.close()
+            if self.conn is not None:
+                await self.conn.close()
+        self.session = None
+        self.conn = None
+        return self.session
+
+    def _baseurl(self):
+        return self.api_url or self.base_urls[bool(self.public)]
+
+    async def do_request_async(self, url):
+        """Async HTTP GET with retry + token auth"""
+
+        if self.predictions:
+            if "?" in url:
+                url += "&predictions=1"
+            else:
+                url += "?predictions=1"
+        try:
+            self.session = await self.get_session()
+        except Exception as e:
+            print(f"Error getting session: {e}")
+            return {}, {}
+        timeout = self._timeout()
+        endpoint = self._endpoint(url)
+        limiter = self._limiter(url)
+        breaker = self.breaker or breaker_for(urlsplit(url).netloc)
+        status = 'No Response'
+        for attempt in range(1, self.max_retries + 1):
+            if not breaker.allow():
+                # the host failed repeatedly, fail fast until the breaker lets a probe through
+                self.metrics.rejected(endpoint)
+                raise RuntimeError(f"Circuit open for {urlsplit(url).netloc}, not requesting {url}")
+            if self.tokens.expires_soon():
+                # refresh ahead of expiry instead of waiting for a 401
+                await self.refresh_tokens()
+            access_token = self.access_token = self.tokens.access_token
+            headers = {
+                "Accept": "application/json",
+                "Authorization": f"Bearer {access_token}"
+            }
+            try:
+                return await self._get_async(url, headers, timeout, endpoint, limiter, breaker)
+            except attempt_failed as failed:
+                status = failed.status
+                if failed.status == 'error':
+                    print(f"Retrying {url}, attempt {attempt}")
+                if attempt < self.max_retries:
+                    self.metrics.retry(endpoint, status)
+                if failed.expired:
+                    # refresh token unless another request already did
+                    await self.refresh_tokens(access_token)
+                    continue
+                if breaker.state == 'open':
+                    raise RuntimeError(f"Circuit open for {urlsplit(url).netloc}, giving up on {url}")
+                if attempt < self.max_retries:
+                    await asyncio.sleep(backoff_delay(attempt, failed.retry_after))
+
+        raise RuntimeError(f"Failed to GET {url} after {self.max_retries} retries {status}")
+
+    async def _get_async(self, url, headers, timeout, endpoint, limiter, breaker):
+        ''' One GET attempt of do_request_async, hedged if self.hedge is set.
+
+        Only the attempt is hedged: a hedge is sent when the request itself is
+        slow, never while do_request_async waits to retry.
+        '''
+        def attempt():
+            return self._attempt_async(url, headers, timeout, endpoint, limiter, breaker)
+
+        if not self.hedge:
+            return await attempt()
+        delay = self.hedge_delay or limiter.p95() or 1.0
+        return await hedged(attempt, delay, lambda won: self.metrics.hedge(endpoint, won))
+
+    async def _attempt_async(self, url, headers, timeout, endpoint, limiter, breaker):
+        ''' Send one GET and return (resp, data), raising attempt_failed otherwise '''
+        expired = False
+        retry_after = None
+        waited = time.monotonic()
+        await limiter.acquire()
+        start = time.monotonic()
+        self.metrics.limiter_wait(start - waited)
+        status = 'error'
+        outcome = None
+        try:
+            async with self.session.get(url, headers=headers, timeout=timeout) as resp:
+                status = resp.status
+                if resp.status == 401:
+                    expired = True
+                    outcome = True
+                elif resp.status in RETRYABLE:
+                    # gateway errors say the host is down; a 500 may be this URL only and 429 that we are too fast
+                    outcome = False if resp.status in HOST_FAILURES else None
+                    # Retryable errors, slow down if the server tells us to
+                    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                    if resp.status in THROTTLED:
+                        limiter.on_throttle(retry_after)
+                else:
+                    # Return JSON for non-error statuses
+                    outcome = True
+                    body = await resp.read()
+                    data = await self.decoder.decode(body)
+                    limiter.on_success(time.monotonic() - start)
+                    self.metrics.request(endpoint, status, time.monotonic() - start, len(body))
+                    return resp, data
+
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            outcome = False
+        finally:
+            limiter.release()
+            if outcome is True:
+                breaker.success()
+            elif outcome is False:
+                breaker.failure()
+            else:
+                breaker.abandon()
+        self.metrics.request(endpoint, status, time.monotonic() - start)
+        raise attempt_failed(status, retry_after, expired)
+
+    def _timeout(self):
+        return aiohttp.ClientTimeout(total=self.request_timeout, sock_connect=self.connect_timeout,
+                                     sock_read=self.read_timeout)
+
+    def _limiter(self, url):
+        return self.limiter or limiter_for(urlsplit(url).netloc, **self.limits)
+
+    def _endpoint(self, url):
+        ''' Endpoint name of an API URL, used to label metrics '''
+        baseurl = self._baseurl()
+        if url.startswith(baseurl):
+            url = url[len(baseurl):]
+        elif url.startswith("http"):
+            url = urlsplit(url).path
+        return endpoint_of('/' + url.lstrip('/'))
+
+    async def do_api_call_async(self, url, cached=True):
+        if not url.startswith("http"):
+            url = self._baseurl() + url
+        if self.cache is not None and cached:
+            data = await asyncio.to_thread(self.cache.get, url, self.predictions)
+            self.metrics.cache('response', data is not None, data is None)
+            if data is not None:
+                return data
+            if self.cache.offline:
+                print(f"Offline mode: no cached response for {url}")
+                return {}
+        key = f"{normalize_url(url)}#predictions={int(bool(self.predictions))}"
+        return await self.inflight.do(key, lambda: self._request_data_async(url))
+
+    async def _request_data_async(self, url):
+        ''' Request `url` and return its data, storing successful responses in the cache '''
+        try:
+            resp, data = await self.do_request_async(url)
+        except Exception as e:
+            print(f"Error retrieving data from request_async {url}: {e}")
+            return {}
+        if resp.status in (500, 400, 503):
+            print(f"Error {resp.status}: {data}")
+            return data
+        elif (resp.status == 401):
+            # Access token might have expired (15 minutes life time).
+            # Get new tokens using refresh token and try again.
+            await self.refresh_tokens()
+            return await self._request_data_async(url)
+        if self.cache is not None and resp.status == 200:
+            await asyncio.to_thread(self.cache.set, url, self.predictions, data)
+        return data
+
+    async def fetch_map_async(self, ids, strict=False, cached=True):
+        ''' Fetch the entries for `ids` as a dict keyed by ID.
+
+        IDs found in the record cache are not requested again and the rest is
+        split into fetch/ calls of at most MAX_FETCH_IDS IDs each. With
+        `strict` a failed fetch/ call raises a RuntimeError describing it
+        instead of leaving its IDs out, and `cached=False` skips both caches
+        to get the current records.
+        '''
+        ids = unique(ids)
+        found = {}
+        if self.record_cache is not None and cached:
+            found = await asyncio.to_thread(self.record_cache.get_many, self.source, ids, self.predictions)
+            self.metrics.cache('record', len(found), len(ids) - len(found))
+        missing = [i for i in ids if i not in found]
+        for part in await asyncio.gather(*[self._fetch_ids_async(b, strict, cached) for b in chunked(missing)]):
+            found.update(part)
+        return found
+
+    async def _fetch_ids_async(self, ids, strict, cached):
+        ''' One fetch/ call for at most MAX_FETCH_IDS IDs already looked up in the record cache '''
+        entries = await self.do_api_call_async("fetch/" + ";".join(ids), cached)
+        fetched = self._records_of(entries)
+        if strict and fetched is None:
+            raise RuntimeError(f"Fetching {ids[0]}..{ids[-1]} failed: {entries}")
+        if fetched is None:
+            return {}
+        if self.record_cache is not None:
+            await asyncio.to_thread(self.record_cache.set_many, self.source, fetched, self.predictions)
+        return fetched
+
+    async def fetch_entries_async(self, ids):
+        ''' Fetch the entries for `ids` in order, only requesting IDs missing from the record cache '''
+        ids = [str(i) for i in ids]
+        found = await self.fetch_map_async(ids)
+        return [found[i] for i in ids if i in found]
+
+    async def _fetch_batch_async(self, ids):
+        try:
+            return await self.fetch_entries_async(ids)
+        except Exception as e:
+            print(f"Error fetching entries {ids[0]}..{ids[-1]}: {e}")
+            return []
+
+    def _split_results(self, result):
+        ''' Split a listing response into (ids, entries returned inline) '''
+        results = result.get('results') or []
+        if results and isinstance(results[0], dict):
+            return [], [el for el in results]
+        return [str(i) for i in results], []
+
+    async def list_page_async(self, url):
+        ''' Return (ids, entries) for one listing page '''
+        try:
+            return self._split_results(await self.do_api_call_async(url))
+        except Exception as e:
+            print(f"Error retrieving entries from {url}: {e}")
+            return [], []
+
+    async def _checked_page_async(self, url, cached=True):
+        ''' Like list_page_async but raises if the page could not be retrieved '''
+        result = await self.do_api_call_async(url, cached)
+        if not isinstance(result, dict) or not isinstance(result.get('results'), list):
+            raise RuntimeError(f"Listing {url} failed: {result}")
+        ids, entries = self._split_results(result)
+        return ids, {str(el['id']): el for el in entries}
+
+    async def _as_handle(self, url=None):
+        ''' Wrap `url`, or the current search state, in a search_result '''
+        if url is not None:
+            return search_result(url, url, await self.do_api_call_async(url))
+        handle = search_result(None, self.url, self.result)
+        handle.projection = self.projection
+        return handle
+
+    def _count(self, handle):
+        if isinstance(handle.result, dict) and 'count' not in handle.result and handle.result:
+            print(f"Error retrieving count from result: {handle.result}")
+        return handle.count
+
+    def _plan(self, handle):
+        ''' Return (listing URLs, already known IDs, known pages) for retrieving a search.
+
+        The search response is page 0 of handle.url: its IDs are known and
+        records it holds inline are passed on as an already listed page
+        {url: (ids, {id: entry})}, so only the remaining pages are requested.
+        '''
+        ids, inline = self._split_results(handle.result)
+        urls = []
+        if handle.url is not None and len(handle.result['results']) < handle.count:
+            urls = self._page_urls(handle.url, handle.count)[1:]
+        known = {handle.url: ([], {str(el['id']): el for el in inline})} if inline else {}
+        return urls, ids, known
+
+    async def retrieve_async(self, handle=None, listing_workers=10, fetch_workers=20, checkpoint=None, fields=None,
+                             compact=False, url=None):
+        ''' Retrieve all entries of a search: `handle`, the search at `url` or the current one.
+
+        `fields` keeps only the given field paths of every record as soon as
+        it is fetched (see projection), `compact` returns namedtuples instead
+        of dicts; by default the projection of the search (async_search) is used.
+
+        With `checkpoint` (a retrieval_checkpoint or the path of one) completed
+        pages and fetched records are saved as they arrive, so calling this
+        again after a crash only retrieves the missing work. Pages and batches
+        that still fail are reported, kept in the checkpoint for the next run and
+        listed in self.last_summary.failed (and handle.failed).
+
+        Request, retry, cache and latency totals of the call are kept in a
+        retrieval_summary, available as self.last_summary (and handle.summary).
+        '''
+        self.session = await self.get_session()
+        summary = retrieval_summary()
+        previous = current_summary.set(summary)
+        entries = []
+        try:
+            if handle is None:
+                handle = await self._as_handle(url)
+            handle.summary = summary
+            project = projection_for(fields, compact) or handle.projection
+            count = self._count(handle)
+            if count > 0 and checkpoint is not None:
+                entries = await self._retrieve_checkpointed(handle, checkpoint, listing_workers, fetch_workers)
+                if project is not None:
+                    entries = project.many(entries)
+            elif count > 0:
+                async for batch in self._iter_batches(handle, listing_workers, fetch_workers, project):
+                    entries.extend(batch)
+        finally:
+            current_summary.reset(previous)
+            self.last_summary = summary.finish(len(entries))
+        return entries
+
+    async def _retrieve_checkpointed(self, handle, checkpoint, listing_workers=10, fetch_workers=20):
+        if not isinstance(checkpoint, retrieval_checkpoint):
+            checkpoint = retrieval_checkpoint(checkpoint)
+        urls, ids, known = self._plan(handle)
+        key = search_key(handle.url, handle.count, ids)
+        entries = await checkpointed_entries(checkpoint, key, self._checked_page_async,
+                                             lambda batch: self.fetch_map_async(batch, strict=True),
+                                             list(known) + urls, ids, listing_workers, fetch_workers, known=known)
+        failed_pages = await asyncio.to_thread(checkpoint.failed_pages)
+        failed_batches = await asyncio.to_thread(checkpoint.failed_batches)
+        handle.failed = handle.summary.failed = {'pages': failed_pages, 'batches': failed_batches}
+        if failed_pages or failed_batches:
+            print(f"Incomplete retrieval: {len(failed_pages)} pages and {len(failed_batches)} fetch batches failed, "
+                  f"call again with checkpoint {checkpoint.path} to retry them")
+            for url, error in failed_pages.items():
+                print(f"  {url}: {error}")
+        return entries
+
+    async def _iter_batches(self, handle, listing_workers=10, fetch_workers=20, project=None):
+        ''' Yield lists of entries for a search, repacking the IDs of all listing
+        pages into full fetch/ batches. The IDs of the search response are
+        fetched right away while the remaining pages are listed.
+        '''
+        if handle.count <= 0:
+            return
+        urls, ids, known = self._plan(handle)
+        for _, inline in known.values():
+            # records of the search response are passed on before any further request
+            entries = list(inline.values())
+            yield project.many(entries) if project is not None else entries
+        list_page = self.list_page_async
+        fetch_batch = self._fetch_batch_async
+        if project is not None:
+            async def fetch_batch(batch):
+                # prune right after decoding so only projected records are queued and kept
+                return project.many(await self._fetch_batch_async(batch))
+
+            async def list_page(url):
+                page_ids, entries = await self.list_page_async(url)
+                return page_ids, project.many(entries)
+
+        async for entries in packed_entries(list_page, fetch_batch, urls, ids,
+                                            listing_workers, fetch_workers):
+            yield entries
+
+    async def list_ids_async(self, handle, cached=True):
+        ''' Return (ids, {id: entry returned inline}) for every hit of a search;
+        raises if a page cannot be listed. `cached=False` lists the pages anew. '''
+        if self._count(handle) <= 0:
+            return [], {}
+        urls, ids, known = self._plan(handle)
+        pages = list(known.values()) + await asyncio.gather(*[self._checked_page_async(u, cached) for u in urls])
+        inline = {}
+        for _, entries in pages:
+            inline.update(entries)
+        return unique(list(ids) + [i for page_ids, _ in pages for i in page_ids]), inline
+
+    async def _collect(self, handle):
+        ''' Return (ids, inline entries) of a search, listing its pages if needed '''
+        if self._count(handle) <= 0:
+            return [], []
+        urls, ids, known = self._plan(handle)
+        pages = [([], list(inline.values())) for _, inline in known.values()]
+        pages += await asyncio.gather(*[self.list_page_async(u) for u in urls])
+        return (unique(list(ids) + [i for page_ids, _ in pages for i in page_ids]),
+                [e for _, entries in pages for e in entries])
+
+    async def aiter_records(self, handle=None, listing_workers=10, fetch_workers=20, fields=None, compact=False,
+                            url=None):
+        ''' Yield entries as each fetch/ batch finishes instead of collecting them all.
+
+        `listing_workers` list search pages while `fetch_workers` fetch the full
+        ID batches; the bounded queues between them hold the pipeline back
+        when the consumer is slower than the API. `handle`, `url`, `fields`
+        and `compact` work as in retrieve_async.
+        '''
+        self.session = await self.get_session()
+        summary = retrieval_summary()
+        # the summary is only set while this generator runs (and in the workers it
+        # starts), the consumer's own requests between two entries are not counted;
+        # restored by value: an async generator may be resumed from another context
+        previous = current_summary.get()
+        current_summary.set(summary)
+        self.last_summary = summary
+        try:
+            if handle is None:
+                handle = await self._as_handle(url)
+            handle.summary = summary
+            project = projection_for(fields, compact) or handle.projection
+            if self._count(handle) <= 0:
+                return
+            # closed right away with this generator, which stops its workers and their requests
+            async with aclosing(self._iter_batches(handle, listing_workers, fetch_workers, project)) as batches:
+                async for entries in batches:
+                    summary.records += len(entries)
+                    current_summary.set(previous)
+                    try:
+                        for entry in entries:
+                            yield entry
+                    finally:
+                        previous = current_summary.get()
+                        current_summary.set(summary)
+        finally:
+            current_summary.set(previous)
+            summary.finish()
+
+    stream = aiter_records
+
+    async def export_async(self, path, handle=None, format=None, batch_size=1000, url=None, **options):
+        ''' Stream the entries of a search into a JSONL or Parquet file batch by batch.
+
+        `options` configure the flattening and projection (sections, fields,
+        sep, depth, lists), see export.flattener. Returns the number of records.
+        '''
+        return await export_async(self.aiter_records(handle=handle, url=url), path, format, batch_size=batch_size,
+                                  **options)
+
+    async def retrieve_many(self, handles, concurrency=20, pack=False, fields=None, compact=False):
+        ''' Retrieve the entries of many search_result handles over this client's
+        session, token and limiter, yielding (handle, entries) as each one completes.
+
+        With `pack` the IDs of all handles are pooled, deduplicated and fetched
+        in full batches, which saves round-trips for many small searches.
+        `fields` and `compact` work as in retrieve_async.
+        '''
+        self.session = await self.get_session()
+
+        if pack:
+            async for item in self._retrieve_packed(list(handles), concurrency, projection_for(fields, compact)):
+                yield item
+            return
+
+        async def run(handle):
+            return handle, await self.retrieve_async(handle=handle, fields=fields, compact=compact)
+
+        async for item in bounded_as_completed((run(h) for h in handles), concurrency):
+            yield item
+
+    async def _retrieve_packed(self, handles, concurrency, project=None):
+        collected = await asyncio.gather(*[self._collect(h) for h in handles])
+        if project is not None:
+            collected = [(ids, project.many(inline)) for ids, inline in collected]
+        waiting = {}
+        remaining = []
+        for n, (ids, _) in enumerate(collected):
+            remaining.append(set(ids))
+            for i in ids:
+                waiting.setdefault(i, []).append(n)
+        for n, handle in enumerate(handles):
+            if not remaining[n]:
+                yield handle, collected[n][1]
+        found = {}
+
+        async def fetch(batch):
+            try:
+                entries = await self.fetch_map_async(batch)
+                if project is not None:
+                    entries = {k: project(v) for k, v in entries.items()}
+                return batch, entries
+            except Exception as e:
+                print(f"Error fetching entries {batch[0]}..{batch[-1]}: {e}")
+                return batch, {}
+
+        async for batch, entries in bounded_as_completed(
+                (fetch(b) for b in chunked(list(waiting))), concurrency):
+            found.update(entries)
+            for i in batch:
+                for n in waiting[i]:
+                    remaining[n].discard(i)
+                    if not remaining[n]:
+                        ids, inline = collected[n]
+                        yield handles[n], inline + [found[x] for x in ids if x in found]
+
+    async def search_and_retrieve(self, fields=None, compact=False, listing_workers=10, fetch_workers=20, **params):
+        ''' Search with the parameters of async_query and retrieve every hit;
+        returns (handle, entries).
+
+        The search response doubles as the first listing page: records it
+        holds inline are used as they are and its IDs are sent to fetch/ right
+        away while the other pages are listed, so no page is downloaded twice.
+        '''
+        handle = await self.async_query(fields, compact, **params)
+        entries = []
+        if handle.count > 0:
+            entries = await self.retrieve_async(handle=handle, listing_workers=listing_workers,
+                                                fetch_workers=fetch_workers)
+        return handle, entries
+
+    def retrieve(self, checkpoint=None):
+        ''' Blocking retrieve_async of the current search.
+
+        Runs on the shared background loop, which keeps the session open for
+        the next call and also works where a loop is already running (Jupyter).
+        '''
+        return shared_loop().track(self).run(self.retrieve_async(checkpoint=checkpoint))
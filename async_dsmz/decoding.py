@@ -0,0 +1,48 @@
+# JSON decoding of API responses
+import asyncio
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def default_loads():
+    ''' Return the fastest available JSON decoder: orjson, msgspec or the stdlib '''
+    if orjson is not None:
+        return orjson.loads
+    if msgspec is not None:
+        return msgspec.json.decode
+    return json.loads
+
+
+class json_decoder:
+    ''' Decode response bodies with a pluggable `loads` function.
+
+    Decoding runs on the event loop by default. orjson, msgspec and the
+    stdlib decoder all hold the GIL while building the result, so handing
+    large bodies to a thread pool does not shorten the stall of the loop, and
+    a process pool does not either because the result is unpickled in this
+    process again (both were slower than decoding inline). Keep bodies small
+    instead (fetch/ batches of 100 IDs) or spread decoding over processes
+    with sharded_crawler. `threshold`/`executor` still send bodies of at
+    least `threshold` bytes to `executor`, for a `loads` that releases the GIL.
+    '''
+    def __init__(self, loads=None, threshold=None, executor=None):
+        self.loads = loads or default_loads()
+        self.threshold = threshold
+        self.executor = executor
+
+    async def decode(self, body):
+        if not body:
+            return None
+        if self.threshold is None or len(body) < self.threshold:
+            return self.loads(body)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.loads, body)
@@ -0,0 +1,121 @@
+# Joining LPSN names with their BacDive strains
+import asyncio
+
+
+def taxon_key(record, level=None):
+    ''' (genus, species epithet, subspecies epithet) of an LPSN record.
+
+    `level` ('genus', 'species' or 'subspecies') cuts the key to that rank,
+    by default it is as specific as the name. None for names above genus.
+    '''
+    genus = record.get('genus_name')
+    if not genus:
+        return None
+    key = [genus]
+    ranks = {'genus': 1, 'species': 2, 'subspecies': 3}.get(level, 3)
+    for field in ('sp_epithet', 'subsp_epithet')[:ranks - 1]:
+        epithet = record.get(field)
+        if not epithet:
+            break
+        key.append(epithet)
+    return tuple(key)
+
+
+class taxon_linker:
+    ''' Memoized BacDive taxon lookups for enriching LPSN records.
+
+    Every distinct taxon is searched and retrieved once, however many LPSN
+    records share it, and concurrent joins on the same taxon wait for the
+    same lookup. At most `concurrency` lookups run at once. With `ids_only`
+    only the BacDive-IDs are listed, otherwise the strain records (reduced
+    to `fields`, see projection). The memoized lists are shared between
+    joins, treat them as read-only. Reuse one linker to keep the memo
+    across several enrichments.
+    '''
+    def __init__(self, bacdive, concurrency=20, ids_only=False, fields=None, compact=False, level=None):
+        self.bacdive = bacdive
+        self.ids_only = ids_only
+        self.fields = fields
+        self.compact = compact
+        self.level = level
+        self.memo = {}
+        self.lookups = 0
+        self._limit = asyncio.Semaphore(concurrency)
+
+    async def strains(self, key):
+        ''' BacDive strains (or IDs) of the taxon `key`, None if the lookup failed '''
+        task = self.memo.get(key)
+        if task is None:
+            task = self.memo[key] = asyncio.ensure_future(self._lookup(key))
+        return await asyncio.shield(task)
+
+    async def _lookup(self, key):
+        async with self._limit:
+            self.lookups += 1
+            handle = await self.bacdive.async_query(taxonomy=list(key))
+            try:
+                if not handle.result or 'count' not in handle.result:
+                    raise RuntimeError(f"BacDive search for {' '.join(key)} failed")
+                if handle.count <= 0:
+                    return []
+                if self.ids_only:
+                    ids, _ = await self.bacdive.list_ids_async(handle)
+                    return ids
+                return await self.bacdive.retrieve_async(handle=handle, fields=self.fields, compact=self.compact)
+            except Exception as e:
+                print(f"Error looking up {' '.join(key)} in BacDive: {e}")
+                # forget the failure so a later join tries again
+                del self.memo[key]
+                return None
+
+    async def join(self, record):
+        ''' {'lpsn': record, 'taxon': key, 'bacdive': strains} for one LPSN record '''
+        key = taxon_key(record, self.level)
+        strains = [] if key is None else await self.strains(key)
+        return {'lpsn': record, 'taxon': key, 'bacdive': strains}
+
+
+async def _aiter(records):
+    if hasattr(records, '__aiter__'):
+        async for record in records:
+            yield record
+    else:
+        for record in records:
+            yield record
+
+
+async def enrich_async(lpsn, bacdive, handle=None, records=None, linker=None, concurrency=20, window=200,
+                       **options):
+    ''' Yield LPSN records joined with their BacDive strains as each join completes.
+
+    LPSN records are streamed from `handle` (default: lpsn's current search)
+    or taken from `records`, a list or async iterable, and looked up in
+    BacDive by genus, species and subspecies epithet through a taxon_linker
+    (built from `concurrency` and `options` unless given). Up to `window`
+    joins are in flight while the LPSN side keeps streaming, so both APIs
+    are queried at the same time. Results come in completion order as
+    {'lpsn': record, 'taxon': key, 'bacdive': strains}.
+
+        async for row in enrich_async(lpsn, bacdive, await lpsn.async_query(taxon_name='Bacillus')):
+            ...
+    '''
+    linker = linker or taxon_linker(bacdive, concurrency, **options)
+    source = _aiter(records) if records is not None else lpsn.aiter_records(handle=handle)
+    pending = set()
+    try:
+        async for record in source:
+            pending.add(asyncio.ensure_future(linker.join(record)))
+            if len(pending) >= window:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                done = {task for task in pending if task.done()}
+                pending -= done
+            for task in done:
+                yield task.result()
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
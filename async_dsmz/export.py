@@ -0,0 +1,201 @@
+# Streaming export of retrieved records to JSONL, Arrow and Parquet
+import asyncio
+import gzip
+import json
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class flattener:
+    ''' Turn nested BacDive/LPSN records into flat rows of `sep`-joined column names.
+
+    `sections` limits the top-level keys (BacDive sections such as
+    "Name and taxonomic classification", or LPSN fields) that are kept; a dict
+    also renames them, e.g. {'Name and taxonomic classification': 'taxonomy'}.
+    Values nested deeper than `depth` levels are stored as JSON strings, as are
+    lists unless `lists` is 'first', which flattens the first element only.
+    `fields` projects the result onto the given column names or prefixes.
+    '''
+    def __init__(self, sections=None, fields=None, sep='.', depth=None, lists='json'):
+        if sections is not None and not isinstance(sections, dict):
+            sections = {s: s for s in sections}
+        self.sections = sections
+        self.fields = list(fields) if fields is not None else None
+        self.sep = sep
+        self.depth = depth
+        self.lists = lists
+
+    def __call__(self, record):
+        row = {}
+        if self.sections is None:
+            items = record.items()
+        else:
+            items = ((self.sections[k], v) for k, v in record.items() if k in self.sections)
+        for key, value in items:
+            self._flatten(row, str(key), value, 1)
+        if self.fields is not None:
+            row = {k: v for k, v in row.items() if self._wanted(k)}
+        return row
+
+    def _wanted(self, column):
+        return any(column == f or column.startswith(f + self.sep) for f in self.fields)
+
+    def _flatten(self, row, key, value, level):
+        if isinstance(value, list) and self.lists == 'first':
+            value = value[0] if value else None
+        if isinstance(value, dict) and (self.depth is None or level < self.depth):
+            for k, v in value.items():
+                self._flatten(row, f"{key}{self.sep}{k}", v, level + 1)
+        elif isinstance(value, (dict, list)):
+            row[key] = json.dumps(value, ensure_ascii=False)
+        else:
+            row[key] = value
+
+
+class jsonl_writer:
+    ''' Write one JSON document per line, gzip compressed if `path` ends in .gz '''
+    def __init__(self, path):
+        self.path = path
+        self._file = gzip.open(path, 'wt', encoding='utf-8') if path.endswith('.gz') else open(path, 'w', encoding='utf-8')
+
+    def write(self, rows):
+        self._file.write(''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows))
+
+    def close(self):
+        self._file.close()
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("Arrow and Parquet export require the pyarrow package")
+
+
+def record_batch(rows, schema=None):
+    ''' Build an Arrow RecordBatch of string columns from flat rows.
+
+    Values are stored as strings because the same BacDive field holds numbers
+    in one record and text in another. With `schema` the columns are fixed and
+    keys missing from it are dropped.
+    '''
+    _require_pyarrow()
+    if schema is None:
+        columns = list(dict.fromkeys(k for row in rows for k in row))
+        schema = pyarrow.schema([(c, pyarrow.string()) for c in columns])
+    rows = [{k: None if v is None else str(v) for k, v in row.items()} for row in rows]
+    return pyarrow.RecordBatch.from_pylist(rows, schema=schema)
+
+
+class parquet_writer:
+    ''' Write flat rows to a Parquet file one row group per batch.
+
+    Without a `schema` the columns are collected from the rows. When a batch
+    brings columns not seen before, the rows written so far are kept in a
+    part file and a new part with the wider schema is started; close() merges
+    the parts into `path` one row group at a time, filling the missing
+    columns with nulls. Pass `fields` to the flattener (or a `schema`, which
+    drops other keys) to fix the columns up front and write `path` directly.
+    '''
+    def __init__(self, path, schema=None, compression='zstd'):
+        _require_pyarrow()
+        self.path = path
+        self.schema = schema
+        self.compression = compression
+        self._fixed = schema is not None
+        self._writer = None
+        self._parts = []
+
+    def write(self, rows):
+        if not self._fixed:
+            columns = list(self.schema.names) if self.schema is not None else []
+            new = [c for c in dict.fromkeys(k for row in rows for k in row) if c not in set(columns)]
+            if new:
+                self.schema = pyarrow.schema([(c, pyarrow.string()) for c in columns + new])
+                self._start_part()
+        elif self._writer is None:
+            self._start_part()
+        self._writer.write_batch(record_batch(rows, self.schema))
+
+    def _start_part(self):
+        if self._writer is not None:
+            self._writer.close()
+        path = self.path if self._fixed else f"{self.path}.part{len(self._parts)}"
+        self._parts.append(path)
+        self._writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=self.compression)
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        if self._fixed:
+            return
+        if len(self._parts) == 1:
+            os.replace(self._parts[0], self.path)
+            return
+        with pyarrow.parquet.ParquetWriter(self.path, self.schema, compression=self.compression) as writer:
+            for part in self._parts:
+                parquet = pyarrow.parquet.ParquetFile(part)
+                for n in range(parquet.num_row_groups):
+                    table = parquet.read_row_group(n)
+                    for column in self.schema.names[table.num_columns:]:
+                        table = table.append_column(column, pyarrow.nulls(table.num_rows, pyarrow.string()))
+                    writer.write_table(table)
+                os.remove(part)
+
+
+def writer_for(path, format=None):
+    ''' Pick a writer from `format` ('jsonl' or 'parquet') or the file extension '''
+    if format is None:
+        format = 'parquet' if path.endswith('.parquet') else 'jsonl'
+    if format == 'parquet':
+        return parquet_writer(path)
+    if format == 'jsonl':
+        return jsonl_writer(path)
+    raise ValueError(f"Unknown export format: {format}")
+
+
+async def aiter_record_batches(records, flatten=None, batch_size=1000):
+    ''' Yield Arrow RecordBatches of `batch_size` flattened records from an async iterable '''
+    _require_pyarrow()
+    flatten = flatten or flattener()
+    rows = []
+    async for record in records:
+        rows.append(flatten(record))
+        if len(rows) >= batch_size:
+            yield record_batch(rows)
+            rows = []
+    if rows:
+        yield record_batch(rows)
+
+
+async def export_async(records, path, format=None, flatten=None, batch_size=1000, **options):
+    ''' Stream records from an async iterable (e.g. client.aiter_records()) into `path`.
+
+    Records are flattened with `flatten` (or a flattener built from
+    `options`, see flattener) and written every `batch_size` records, so no
+    more than one batch is held in memory. JSONL files keep the records
+    nested unless flattening options are given. Returns the number of records.
+    '''
+    if flatten is None and (options or format == 'parquet' or path.endswith('.parquet')):
+        flatten = flattener(**options)
+    writer = writer_for(path, format)
+    rows = []
+    n = 0
+    try:
+        async for record in records:
+            rows.append(flatten(record) if flatten is not None else record)
+            if len(rows) >= batch_size:
+                await asyncio.to_thread(writer.write, rows)
+                n += len(rows)
+                rows = []
+        if rows:
+            await asyncio.to_thread(writer.write, rows)
+            n += len(rows)
+    finally:
+        writer.close()
+    return n
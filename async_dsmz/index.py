@@ -0,0 +1,245 @@
+# Queryable local index over BacDive strain records
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+
+_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+_POSITIVE = ('positive', 'yes', '+')
+
+
+def _as_list(value):
+    ''' BacDive sections hold either a single dict or a list of them '''
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _range(value):
+    ''' Parse "37", "28-30", "-2-10" or "6.0 - 8.5" into (low, high) or None '''
+    value = str(value).strip()
+    numbers = [float(n) for n in _NUMBER.findall(value)]
+    if not numbers:
+        return None
+    if value.startswith('-'):
+        # only a leading minus is a sign, the others separate a range
+        numbers[0] = -numbers[0]
+    return min(numbers), max(numbers)
+
+
+def _positive_ranges(entries, field, flag):
+    ''' (low, high) of every growth observation that was not negative '''
+    ranges = []
+    for entry in _as_list(entries):
+        if not isinstance(entry, dict) or str(entry.get(flag, 'positive')).lower() not in _POSITIVE:
+            continue
+        parsed = _range(entry.get(field, ''))
+        if parsed is not None:
+            ranges.append(parsed)
+    return ranges
+
+
+def strain_fields(record):
+    ''' Extract the indexed fields of a BacDive strain record; raises ValueError without a BacDive-ID '''
+    general = record.get('General', {})
+    if general.get('BacDive-ID') is None:
+        raise ValueError("record has no General.BacDive-ID, keep it when projecting with fields=")
+    taxonomy = record.get('Name and taxonomic classification', {})
+    growth = record.get('Culture and growth conditions', {})
+    isolation = record.get('Isolation, sampling and environmental information', {})
+    sequences = record.get('Sequence information', {})
+    links = record.get('External links', {})
+
+    temps = _positive_ranges(growth.get('culture temp'), 'temperature', 'growth')
+    phs = _positive_ranges(growth.get('culture pH'), 'pH', 'ability')
+    accessions = [(s.get('accession'), '16S') for s in _as_list(sequences.get('16S sequences'))
+                  if isinstance(s, dict) and s.get('accession')]
+    accessions += [(s.get('accession'), 'genome') for s in _as_list(sequences.get('Genome sequences'))
+                   if isinstance(s, dict) and s.get('accession')]
+    numbers = [n.strip() for n in str(links.get('culture collection no.') or '').split(',') if n.strip()]
+    sources = []
+    for entry in _as_list(isolation.get('isolation')):
+        if isinstance(entry, dict):
+            sources.extend(str(v) for v in _as_list(entry.get('sample type')))
+    keywords = [str(k) for k in _as_list(general.get('keywords'))]
+    return {
+        'id': int(general.get('BacDive-ID')),
+        'genus': taxonomy.get('genus'),
+        'species': taxonomy.get('species'),
+        'name': taxonomy.get('full scientific name') or taxonomy.get('species'),
+        'family': taxonomy.get('family'),
+        'type_strain': str(taxonomy.get('type strain', '')).lower() == 'yes',
+        'temp_min': min((r[0] for r in temps), default=None),
+        'temp_max': max((r[1] for r in temps), default=None),
+        'ph_min': min((r[0] for r in phs), default=None),
+        'ph_max': max((r[1] for r in phs), default=None),
+        'accessions': accessions,
+        'culture_numbers': numbers,
+        'isolation': ' '.join(sources),
+        'keywords': ' '.join(keywords),
+    }
+
+
+def _normalize_number(number):
+    # "DSM 1234", "DSM-1234" and "dsm1234" are the same culture collection number
+    return re.sub(r'[\s\-_]', '', number).upper()
+
+
+class strain_index:
+    ''' SQLite index over BacDive records for answering filters locally.
+
+    Feed it the results of bacdive_async.retrieve_async (or a mirror) with
+    add(); query() then combines filters on taxonomy, growth temperature and
+    pH, accessions, culture collection numbers, isolation source and full
+    text without any API call. Text search uses SQLite FTS5 when available.
+    '''
+    def __init__(self, path="async_dsmz_index.sqlite"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS strains (
+                id INTEGER PRIMARY KEY, genus TEXT, species TEXT, name TEXT, family TEXT,
+                type_strain INTEGER, temp_min REAL, temp_max REAL, ph_min REAL, ph_max REAL,
+                has_genome INTEGER, isolation TEXT, text TEXT, body TEXT);
+            CREATE INDEX IF NOT EXISTS strains_genus ON strains (genus, species);
+            CREATE INDEX IF NOT EXISTS strains_temp ON strains (temp_max, temp_min);
+            CREATE INDEX IF NOT EXISTS strains_ph ON strains (ph_max, ph_min);
+            CREATE TABLE IF NOT EXISTS accessions (accession TEXT, kind TEXT, id INTEGER);
+            CREATE INDEX IF NOT EXISTS accessions_accession ON accessions (accession);
+            CREATE TABLE IF NOT EXISTS culture_numbers (number TEXT, id INTEGER);
+            CREATE INDEX IF NOT EXISTS culture_numbers_number ON culture_numbers (number);
+        ''')
+        try:
+            self._db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS strains_fts USING fts5(text)')
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5, fall back to LIKE on strains.text
+            self.fts = False
+        self._db.commit()
+
+    def add(self, records):
+        ''' Index BacDive records, given as a list or a dict keyed by ID; returns the number indexed.
+        Records without a BacDive-ID cannot be indexed and are skipped. '''
+        if isinstance(records, dict):
+            records = records.values()
+        n = 0
+        skipped = 0
+        with self._lock:
+            for record in records:
+                try:
+                    f = strain_fields(record)
+                except ValueError:
+                    skipped += 1
+                    continue
+                text = ' '.join(str(v) for v in (f['name'], f['genus'], f['family'], f['isolation'],
+                                                  f['keywords'], ' '.join(f['culture_numbers'])) if v)
+                self._remove(f['id'])
+                self._db.execute('INSERT INTO strains VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (f['id'], f['genus'], f['species'], f['name'], f['family'], f['type_strain'],
+                                  f['temp_min'], f['temp_max'], f['ph_min'], f['ph_max'],
+                                  any(kind == 'genome' for _, kind in f['accessions']),
+                                  f['isolation'], text, json.dumps(record)))
+                self._db.executemany('INSERT INTO accessions VALUES (?, ?, ?)',
+                                     [(a.split('.')[0].upper(), kind, f['id']) for a, kind in f['accessions']])
+                self._db.executemany('INSERT INTO culture_numbers VALUES (?, ?)',
+                                     [(_normalize_number(c), f['id']) for c in f['culture_numbers']])
+                if self.fts:
+                    self._db.execute('INSERT INTO strains_fts (rowid, text) VALUES (?, ?)', (f['id'], text))
+                n += 1
+            self._db.commit()
+        if skipped:
+            print(f"Skipped {skipped} records without General.BacDive-ID, keep it when projecting with fields=")
+        return n
+
+    async def add_async(self, records, batch=500):
+        ''' Index records from an async iterable such as bacdive_async.aiter_records() '''
+        pending = []
+        n = 0
+        async for record in records:
+            pending.append(record)
+            if len(pending) >= batch:
+                n += await asyncio.to_thread(self.add, pending)
+                pending = []
+        if pending:
+            n += await asyncio.to_thread(self.add, pending)
+        return n
+
+    def _remove(self, strain_id):
+        self._db.execute('DELETE FROM strains WHERE id = ?', (strain_id,))
+        self._db.execute('DELETE FROM accessions WHERE id = ?', (strain_id,))
+        self._db.execute('DELETE FROM culture_numbers WHERE id = ?', (strain_id,))
+        if self.fts:
+            self._db.execute('DELETE FROM strains_fts WHERE rowid = ?', (strain_id,))
+
+    def query(self, genus=None, species=None, text=None, isolation=None, min_temp=None, max_temp=None,
+              min_ph=None, max_ph=None, has_genome=None, type_strain=None, accession=None,
+              culture_number=None, limit=None, ids_only=False):
+        ''' Return the records (or BacDive-IDs) matching every given filter.
+
+        min_temp/max_temp select strains reported to grow at or above/below
+        that temperature, likewise min_ph/max_ph. `text` is a full text query
+        over names, isolation source, keywords and culture collection numbers.
+        Example: query(min_temp=60, has_genome=True)
+        '''
+        where, args = [], []
+        if genus is not None:
+            where.append('genus = ?')
+            args.append(genus)
+        if species is not None:
+            where.append('species = ?')
+            args.append(species)
+        if isolation is not None:
+            where.append('isolation LIKE ?')
+            args.append(f'%{isolation}%')
+        for column, op, value in (('temp_max', '>=', min_temp), ('temp_min', '<=', max_temp),
+                                  ('ph_max', '>=', min_ph), ('ph_min', '<=', max_ph)):
+            if value is not None:
+                where.append(f'{column} {op} ?')
+                args.append(value)
+        if has_genome is not None:
+            where.append('has_genome = ?')
+            args.append(bool(has_genome))
+        if type_strain is not None:
+            where.append('type_strain = ?')
+            args.append(bool(type_strain))
+        if accession is not None:
+            where.append('id IN (SELECT id FROM accessions WHERE accession = ?)')
+            args.append(accession.split('.')[0].upper())
+        if culture_number is not None:
+            where.append('id IN (SELECT id FROM culture_numbers WHERE number = ?)')
+            args.append(_normalize_number(culture_number))
+        if text is not None:
+            if self.fts:
+                where.append('id IN (SELECT rowid FROM strains_fts WHERE strains_fts MATCH ?)')
+                args.append(text)
+            else:
+                where.append('text LIKE ?')
+                args.append(f'%{text}%')
+        sql = f"SELECT {'id' if ids_only else 'body'} FROM strains"
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        if ids_only:
+            return [row[0] for row in rows]
+        return [json.loads(row[0]) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM strains').fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            for table in ('strains', 'accessions', 'culture_numbers') + (('strains_fts',) if self.fts else ()):
+                self._db.execute(f'DELETE FROM {table}')
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
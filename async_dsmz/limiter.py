@@ -0,0 +1,214 @@
+# Adaptive concurrency limits and retry backoff for the async clients
+from collections import deque
+from email.utils import parsedate_to_datetime
+import asyncio
+import multiprocessing
+import random
+import time
+import weakref
+from .scheduler import fair_queue
+
+RETRYABLE = (429, 500, 502, 503, 504)
+THROTTLED = (429, 503)
+
+
+def parse_retry_after(value):
+    ''' Parse a Retry-After header (seconds or HTTP date) into seconds, or None '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None, base=1, cap=60):
+    ''' Seconds to wait before retry `attempt`, with full jitter so retries do not stampede '''
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class adaptive_limiter:
+    ''' AIMD limit on the number of in-flight requests to one host.
+
+    The limit grows additively while the p95 latency of recent requests stays
+    within `tolerance` of its baseline and is cut multiplicatively when the
+    server answers 429/503. A Retry-After pause holds back every new request.
+    Requests waiting for a slot are served by priority and fairly between
+    retrievals (see scheduler.fair_queue); a freed slot is handed straight to
+    the next waiter so newcomers cannot jump the queue.
+    '''
+    def __init__(self, initial=20, minimum=1, maximum=200, decrease=0.5, window=50, tolerance=1.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.baseline = None
+        self._latencies = deque(maxlen=window)
+        self._last_decrease = 0.0
+        self._waiters = fair_queue()
+        self._resume = None
+
+    async def acquire(self):
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.in_flight < int(self.limit) and not self._waiters:
+                self.in_flight += 1
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # the slot was handed over just before the cancellation
+                    self.release()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            # _wake handed this request its slot
+            return
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            if self._waiters and self._resume is None:
+                self._resume = asyncio.get_running_loop().call_later(pause, self._resumed)
+            return
+        while self.in_flight < int(self.limit) and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _resumed(self):
+        self._resume = None
+        self._wake()
+
+    def p95(self):
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def on_success(self, latency):
+        ''' Record the latency of a successful request and grow the limit if it is stable '''
+        self._latencies.append(latency)
+        if len(self._latencies) < self._latencies.maxlen:
+            return
+        p95 = self.p95()
+        if self.baseline is None:
+            self.baseline = p95
+        if p95 <= self.baseline * self.tolerance:
+            # roughly +1 per full window of requests at the current limit
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.baseline = 0.9 * self.baseline + 0.1 * p95
+            self._wake()
+
+    def on_throttle(self, retry_after=None):
+        ''' Back off after a 429/503, at most once per latency window '''
+        now = time.monotonic()
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self._last_decrease > (self.p95() or 1.0):
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self._last_decrease = now
+
+
+class request_budget:
+    ''' Token bucket shared by several processes: at most `rate` requests per
+    second, in bursts of up to `burst`, across every process holding it.
+
+    The state lives in shared memory, so create it in the parent and hand it
+    to the workers when they start (e.g. through a pool initializer). A
+    Retry-After pause seen by one process holds back all of them.
+    '''
+    def __init__(self, rate, burst=None, context=None):
+        context = context or multiprocessing.get_context()
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        # tokens, last update, paused until, requests granted
+        self._state = context.Array('d', [self.burst, time.time(), 0.0, 0.0])
+
+    def _take(self):
+        ''' Take one token; return 0 or the seconds to wait before trying again '''
+        with self._state.get_lock():
+            tokens, updated, paused_until, granted = self._state[:]
+            now = time.time()
+            if paused_until > now:
+                return paused_until - now
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+                granted += 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._state[:] = [tokens, now, paused_until, granted]
+            return wait
+
+    async def acquire(self):
+        while (wait := self._take()) > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        with self._state.get_lock():
+            self._state[2] = max(self._state[2], time.time() + seconds)
+
+    @property
+    def granted(self):
+        return int(self._state[3])
+
+
+class budget_limiter:
+    ''' An adaptive_limiter whose requests are also drawn from a request_budget,
+    for use as a client's `limiter` '''
+    def __init__(self, budget, limiter):
+        self.budget = budget
+        self.limiter = limiter
+
+    async def acquire(self):
+        await self.budget.acquire()
+        await self.limiter.acquire()
+
+    def release(self):
+        self.limiter.release()
+
+    def p95(self):
+        return self.limiter.p95()
+
+    def on_success(self, latency):
+        self.limiter.on_success(latency)
+
+    def on_throttle(self, retry_after=None):
+        self.limiter.on_throttle(retry_after)
+        if retry_after is not None:
+            self.budget.pause(retry_after)
+
+
+# event loop -> {host: limiter}, its waiters and timers only work on their own loop
+_limiters = weakref.WeakKeyDictionary()
+
+
+def limiter_for(host, **defaults):
+    ''' Return the limiter shared by every client of the running loop talking to `host` '''
+    hosts = _limiters.setdefault(asyncio.get_running_loop(), {})
+    if host not in hosts:
+        hosts[host] = adaptive_limiter(**defaults)
+    return hosts[host]
@@ -0,0 +1,225 @@
+# Request metrics and tracing hooks for the async clients
+from contextvars import ContextVar
+import time
+import aiohttp
+
+# summary of the retrieve_async/aiter_records call the current task belongs to
+current_summary = ContextVar('current_summary', default=None)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class retrieval_summary:
+    ''' Totals for one retrieval: requests, retries, cache hits, bytes and latency '''
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.records = 0
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.token_refreshes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes = 0
+        self.limiter_wait = 0.0
+        self.latencies = []
+        # {'pages': {url: error}, 'batches': [(ids, error)]} of a checkpointed retrieval
+        self.failed = None
+
+    def finish(self, records=None):
+        self.finished = time.monotonic()
+        if records is not None:
+            self.records = records
+        return self
+
+    def as_dict(self):
+        end = self.finished if self.finished is not None else time.monotonic()
+        return {
+            'seconds': round(end - self.started, 3),
+            'records': self.records,
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'token_refreshes': self.token_refreshes,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'bytes': self.bytes,
+            'limiter_wait_seconds': round(self.limiter_wait, 3),
+            'latency_p50': percentile(self.latencies, 0.50),
+            'latency_p95': percentile(self.latencies, 0.95),
+            'latency_max': max(self.latencies) if self.latencies else None,
+        }
+
+    def __repr__(self):
+        return f"retrieval_summary({self.as_dict()})"
+
+
+class memory_sink:
+    ''' Metrics sink keeping counters and histogram samples in memory '''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def counter(self, name, value=1, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        self.histograms.setdefault(key, []).append(value)
+
+
+class prometheus_sink:
+    ''' Metrics sink exporting to prometheus_client (optional dependency) '''
+    def __init__(self, registry=None):
+        try:
+            import prometheus_client
+        except ImportError as e:
+            raise ImportError("prometheus_sink requires the prometheus_client package") from e
+        self._prometheus = prometheus_client
+        self.registry = registry if registry is not None else prometheus_client.REGISTRY
+        self._metrics = {}
+
+    def _metric(self, kind, name, labels):
+        if name not in self._metrics:
+            self._metrics[name] = kind(name, name.replace('_', ' '), sorted(labels),
+                                       registry=self.registry)
+        metric = self._metrics[name]
+        return metric.labels(**labels) if labels else metric
+
+    def counter(self, name, value=1, labels=None):
+        self._metric(self._prometheus.Counter, name, labels or {}).inc(value)
+
+    def histogram(self, name, value, labels=None):
+        self._metric(self._prometheus.Histogram, name, labels or {}).observe(value)
+
+
+class otel_sink:
+    ''' Metrics sink recording to an OpenTelemetry `Meter` '''
+    def __init__(self, meter):
+        self.meter = meter
+        self._instruments = {}
+
+    def counter(self, name, value=1, labels=None):
+        if name not in self._instruments:
+            self._instruments[name] = self.meter.create_counter(name)
+        self._instruments[name].add(value, attributes=labels)
+
+    def histogram(self, name, value, labels=None):
+        if name not in self._instruments:
+            self._instruments[name] = self.meter.create_histogram(name)
+        self._instruments[name].record(value, attributes=labels)
+
+
+class metrics_recorder:
+    ''' Feed client events to an optional metrics sink and to the current retrieval_summary.
+
+    Metric names follow Prometheus conventions (dsmz_requests_total,
+    dsmz_request_seconds, ...) and carry `api` and `endpoint` labels.
+    '''
+    def __init__(self, api, sink=None):
+        self.api = api
+        self.sink = sink
+
+    def _labels(self, **labels):
+        return {'api': self.api, **{k: str(v) for k, v in labels.items()}}
+
+    def request(self, endpoint, status, seconds, nbytes=0):
+        if self.sink is not None:
+            labels = self._labels(endpoint=endpoint, status=status)
+            self.sink.counter('dsmz_requests_total', 1, labels)
+            self.sink.histogram('dsmz_request_seconds', seconds, labels)
+            if nbytes:
+                self.sink.counter('dsmz_response_bytes_total', nbytes, self._labels(endpoint=endpoint))
+        summary = current_summary.get()
+        if summary is not None:
+            summary.requests += 1
+            summary.latencies.append(seconds)
+            summary.bytes += nbytes
+            if status != 200:
+                summary.errors += 1
+
+    def retry(self, endpoint, reason):
+        if self.sink is not None:
+            self.sink.counter('dsmz_retries_total', 1, self._labels(endpoint=endpoint, reason=reason))
+        summary = current_summary.get()
+        if summary is not None:
+            summary.retries += 1
+
+    def deduplicated(self):
+        if self.sink is not None:
+            self.sink.counter('dsmz_deduplicated_requests_total', 1, self._labels())
+
+    def hedge(self, endpoint, won):
+        if self.sink is not None:
+            self.sink.counter('dsmz_hedged_requests_total', 1, self._labels(endpoint=endpoint, won=won))
+
+    def rejected(self, endpoint):
+        ''' A request refused by an open circuit breaker '''
+        if self.sink is not None:
+            self.sink.counter('dsmz_circuit_rejections_total', 1, self._labels(endpoint=endpoint))
+        summary = current_summary.get()
+        if summary is not None:
+            summary.errors += 1
+
+    def token_refresh(self):
+        if self.sink is not None:
+            self.sink.counter('dsmz_token_refreshes_total', 1, self._labels())
+        summary = current_summary.get()
+        if summary is not None:
+            summary.token_refreshes += 1
+
+    def limiter_wait(self, seconds):
+        if self.sink is not None:
+            self.sink.histogram('dsmz_limiter_wait_seconds', seconds, self._labels())
+        summary = current_summary.get()
+        if summary is not None:
+            summary.limiter_wait += seconds
+
+    def cache(self, kind, hits, misses):
+        if self.sink is not None:
+            if hits:
+                self.sink.counter('dsmz_cache_hits_total', hits, self._labels(cache=kind))
+            if misses:
+                self.sink.counter('dsmz_cache_misses_total', misses, self._labels(cache=kind))
+        summary = current_summary.get()
+        if summary is not None:
+            summary.cache_hits += hits
+            summary.cache_misses += misses
+
+    def connection_wait(self, seconds):
+        if self.sink is not None:
+            self.sink.histogram('dsmz_connection_wait_seconds', seconds, self._labels())
+
+    def connect(self, seconds):
+        if self.sink is not None:
+            self.sink.histogram('dsmz_connect_seconds', seconds, self._labels())
+
+
+def trace_config(recorder):
+    ''' aiohttp TraceConfig reporting connection pool waits and new connections to `recorder` '''
+    config = aiohttp.TraceConfig()
+
+    async def queued_start(session, ctx, params):
+        ctx.queued = time.monotonic()
+
+    async def queued_end(session, ctx, params):
+        recorder.connection_wait(time.monotonic() - ctx.queued)
+
+    async def create_start(session, ctx, params):
+        ctx.connecting = time.monotonic()
+
+    async def create_end(session, ctx, params):
+        recorder.connect(time.monotonic() - ctx.connecting)
+
+    config.on_connection_queued_start.append(queued_start)
+    config.on_connection_queued_end.append(queued_end)
+    config.on_connection_create_start.append(create_start)
+    config.on_connection_create_end.append(create_end)
+    return config
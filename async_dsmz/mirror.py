@@ -0,0 +1,193 @@
+# Incremental local mirror of BacDive/LPSN records
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from .batching import MAX_FETCH_IDS, chunked, unique
+from .streaming import bounded_as_completed
+
+
+def content_hash(record):
+    ''' Stable hash of a record, independent of key order '''
+    body = json.dumps(record, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+class mirror:
+    ''' Local SQLite copy of the records found by a set of searches.
+
+    The first sync() is a full crawl. Later syncs list the searches again
+    (listing pages only carry IDs) and fetch just the IDs that are new, were
+    deleted before, or were last fetched more than `refresh_after` seconds
+    ago. A refreshed record is only rewritten if its content hash changed.
+    Records of IDs that are no longer listed are flagged as deleted.
+
+    Every fetch/ batch is committed as soon as it returns, so an interrupted
+    sync resumes where it stopped: records fetched before the interruption
+    count as fresh and are not requested again. BacDive and LPSN mirrors can
+    share one file; rows are kept apart by the client's `source`.
+    '''
+    def __init__(self, client, path="async_dsmz_mirror.sqlite", refresh_after=30 * 24 * 3600):
+        self.client = client
+        self.source = client.source
+        self.path = path
+        self.refresh_after = refresh_after
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS records (
+            source TEXT, id TEXT, hash TEXT, fetched REAL, changed REAL,
+            deleted INTEGER DEFAULT 0, body TEXT, PRIMARY KEY (source, id))''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS records_changed ON records (source, changed)')
+        self._db.commit()
+
+    # storage
+
+    def _known(self):
+        ''' Return {id: (fetched, deleted)} of every mirrored record '''
+        with self._lock:
+            rows = self._db.execute('SELECT id, fetched, deleted FROM records WHERE source = ?',
+                                    (self.source,)).fetchall()
+        return {i: (fetched, bool(deleted)) for i, fetched, deleted in rows}
+
+    def _store(self, records, requested, now):
+        ''' Save fetched records; requested IDs missing from `records` are flagged deleted.
+        Returns counts of new, changed, unchanged and deleted records. '''
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0}
+        with self._lock:
+            for i in requested:
+                row = self._db.execute('SELECT hash, deleted FROM records WHERE source = ? AND id = ?',
+                                       (self.source, i)).fetchone()
+                if i not in records:
+                    if row is not None and not row[1]:
+                        self._db.execute('UPDATE records SET deleted = 1, changed = ? WHERE source = ? AND id = ?',
+                                         (now, self.source, i))
+                        counts['deleted'] += 1
+                    continue
+                digest = content_hash(records[i])
+                if row is None:
+                    counts['new'] += 1
+                elif row[0] == digest and not row[1]:
+                    self._db.execute('UPDATE records SET fetched = ? WHERE source = ? AND id = ?',
+                                     (now, self.source, i))
+                    counts['unchanged'] += 1
+                    continue
+                else:
+                    counts['changed'] += 1
+                self._db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, 0, ?)',
+                                 (self.source, i, digest, now, now, json.dumps(records[i])))
+            self._db.commit()
+        return counts
+
+    def _mark_deleted(self, ids, now):
+        with self._lock:
+            self._db.executemany('UPDATE records SET deleted = 1, changed = ? WHERE source = ? AND id = ?',
+                                 [(now, self.source, i) for i in ids])
+            self._db.commit()
+
+    # reading
+
+    def get(self, record_id):
+        ''' Return the mirrored record for `record_id`, or None '''
+        with self._lock:
+            row = self._db.execute('SELECT body FROM records WHERE source = ? AND id = ? AND deleted = 0',
+                                   (self.source, str(record_id))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def ids(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT id FROM records WHERE source = ? AND deleted = 0', (self.source,))]
+
+    def records(self):
+        ''' Yield every mirrored (not deleted) record '''
+        with self._lock:
+            rows = self._db.execute('SELECT body FROM records WHERE source = ? AND deleted = 0',
+                                    (self.source,)).fetchall()
+        for (body,) in rows:
+            yield json.loads(body)
+
+    def changed_since(self, timestamp):
+        ''' Return [(id, deleted)] of records added, changed or deleted after `timestamp` '''
+        with self._lock:
+            rows = self._db.execute('SELECT id, deleted FROM records WHERE source = ? AND changed > ?',
+                                    (self.source, timestamp)).fetchall()
+        return [(i, bool(deleted)) for i, deleted in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM records WHERE source = ? AND deleted = 0',
+                                    (self.source,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # syncing
+
+    async def sync(self, searches, concurrency=20, prune=True, refresh_after=None):
+        ''' Bring the mirror up to date with `searches`.
+
+        `searches` are search_result handles or dicts of async_query
+        parameters and together define what is mirrored; with `prune` records
+        they no longer list are flagged deleted. Returns a report with the
+        number of listed, new, changed, unchanged and deleted records and the
+        fetch/ batches that failed (they are retried on the next sync).
+        '''
+        if refresh_after is None:
+            refresh_after = self.refresh_after
+        self.client.session = await self.client.get_session()
+
+        async def as_handle(search):
+            if isinstance(search, dict):
+                # listings come from the API, a cached one would miss new and removed records
+                return await self.client.async_query(cached=False, **search)
+            return search
+
+        handles = await asyncio.gather(*[as_handle(s) for s in searches])
+        for handle in handles:
+            if not isinstance(handle.result, dict) or 'count' not in handle.result:
+                # never prune on the strength of a failed search
+                raise RuntimeError(f"Search failed, not syncing: {handle}")
+        listings = await asyncio.gather(*[self.client.list_ids_async(h, cached=False) for h in handles])
+        listed = unique(i for ids, _ in listings for i in ids)
+        inline = {}
+        for _, entries in listings:
+            inline.update(entries)
+
+        report = {'listed': len(listed), 'new': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0, 'failed': []}
+
+        def add(counts):
+            for k, v in counts.items():
+                report[k] += v
+
+        now = time.time()
+        known = await asyncio.to_thread(self._known)
+        if inline:
+            add(await asyncio.to_thread(self._store, inline, list(inline), now))
+        new = [i for i in listed if i not in inline and (i not in known or known[i][1])]
+        stale = sorted((i for i in listed if i not in inline and i in known and not known[i][1]
+                        and now - (known[i][0] or 0) > refresh_after), key=lambda i: known[i][0] or 0)
+
+        async def fetch(batch):
+            try:
+                return batch, await self.client.fetch_map_async(batch, strict=True, cached=False), None
+            except Exception as e:
+                return batch, None, e
+
+        async for batch, records, error in bounded_as_completed(
+                (fetch(b) for b in chunked(new + stale, MAX_FETCH_IDS)), concurrency):
+            if error is not None:
+                print(f"Error syncing {batch[0]}..{batch[-1]}: {error}")
+                report['failed'].append(batch)
+                continue
+            add(await asyncio.to_thread(self._store, records, batch, time.time()))
+
+        if prune:
+            listed_ids = set(listed)
+            gone = [i for i, (_, deleted) in known.items() if not deleted and i not in listed_ids]
+            if gone:
+                await asyncio.to_thread(self._mark_deleted, gone, time.time())
+                report['deleted'] += len(gone)
+        return report
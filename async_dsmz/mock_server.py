@@ -0,0 +1,287 @@
+# In-process stand-in for the DSMZ Keycloak, BacDive and LPSN APIs
+from aiohttp import web
+import asyncio
+import base64
+import json
+import random
+import time
+
+PAGE_SIZE = 100
+
+
+def make_token(lifetime, kind="access"):
+    ''' Build an unsigned JWT-like token with an `exp` claim '''
+    def part(d):
+        return base64.urlsafe_b64encode(json.dumps(d).encode()).decode().rstrip('=')
+    claims = {'exp': time.time() + lifetime, 'typ': kind, 'jti': random.getrandbits(64)}
+    return f"{part({'alg': 'none'})}.{part(claims)}.mock"
+
+
+def bacdive_record(bacdive_id, genus, padding=0):
+    ''' Synthetic BacDive strain document shaped like the real fetch/ output '''
+    species = f"{genus} sp{bacdive_id % 7}"
+    record = {
+        'General': {
+            '@ref': bacdive_id,
+            'BacDive-ID': bacdive_id,
+            'DSM-Number': bacdive_id,
+            'keywords': ['Bacteria', 'genome sequence'] if bacdive_id % 2 else ['Bacteria'],
+            'description': f"{species} DSM {bacdive_id} is a mock strain.",
+        },
+        'Name and taxonomic classification': {
+            'domain': 'Bacteria',
+            'genus': genus,
+            'species': species,
+            'full scientific name': f"{species} (mock)",
+            'type strain': 'yes' if bacdive_id % 5 == 0 else 'no',
+        },
+        'Culture and growth conditions': {
+            'culture temp': [{'growth': 'positive', 'type': 'growth',
+                              'temperature': str(20 + bacdive_id % 60)}],
+            'culture pH': [{'ability': 'positive', 'type': 'growth', 'pH': str(4 + bacdive_id % 6)}],
+        },
+        'Isolation, sampling and environmental information': {
+            'isolation': {'sample type': ['soil', 'hot spring', 'marine sediment', 'gut'][bacdive_id % 4]},
+        },
+        'Sequence information': {
+            '16S sequences': {'accession': f"AB{bacdive_id:06d}", 'database': 'nuccore'},
+        },
+        'External links': {
+            'culture collection no.': f"DSM {bacdive_id}, ATCC {bacdive_id + 10000}",
+        },
+    }
+    if bacdive_id % 2:
+        record['Sequence information']['Genome sequences'] = {
+            'accession': f"GCA_{bacdive_id:09d}.1", 'database': 'ncbi'}
+    if padding:
+        record['General']['padding'] = 'x' * padding
+    return record
+
+
+def lpsn_record(lpsn_id, genus, padding=0):
+    ''' Synthetic LPSN name record shaped like the real fetch/ output '''
+    record = {
+        'id': lpsn_id,
+        'full_name': f"{genus} sp{lpsn_id % 7}",
+        'category': 'species',
+        'genus_name': genus,
+        'sp_epithet': f"sp{lpsn_id % 7}",
+        'is_legitimate': True,
+        'lpsn_address': f"https://lpsn.dsmz.de/species/mock-{lpsn_id}",
+    }
+    if padding:
+        record['padding'] = 'x' * padding
+    return record
+
+
+class mock_dsmz_server:
+    ''' Local aiohttp server imitating the DSMZ APIs for tests and benchmarks.
+
+    `taxa` maps genus names to the number of BacDive strains (and LPSN names)
+    in the synthetic dataset. Every request waits `latency` seconds (plus up to
+    `jitter`), fetched records are padded by `payload_size` bytes, and
+    `faults` maps status codes (401, 429, 500, 503, ...) to the probability of
+    answering a data request with that error. Access tokens expire after
+    `token_lifetime` seconds. Request and status counts are kept in `stats`.
+
+    BacDive is served under /bacdive/, LPSN under /lpsn/ and the Keycloak
+    token endpoint under /auth/; see bacdive_url, lpsn_url and sso_url.
+    '''
+    def __init__(self, taxa=None, latency=0.0, jitter=0.0, payload_size=0, faults=None,
+                 token_lifetime=900, retry_after=1, seed=0, host='127.0.0.1', port=0):
+        self.taxa = taxa if taxa is not None else {'Bacillus': 1000}
+        self.latency = latency
+        self.jitter = jitter
+        self.payload_size = payload_size
+        self.faults = faults or {}
+        self.token_lifetime = token_lifetime
+        self.retry_after = retry_after
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.tokens = {}
+        self.stats = {'requests': 0, 'endpoints': {}, 'statuses': {}, 'token_requests': 0}
+        self._runner = None
+        # genus -> first ID, so every genus owns a contiguous ID range
+        self._offsets = {}
+        offset = 1
+        for genus, count in self.taxa.items():
+            self._offsets[genus] = offset
+            offset += count
+        self._genus_of = sorted((start, genus) for genus, start in self._offsets.items())
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/"
+
+    @property
+    def bacdive_url(self):
+        return self.url + "bacdive/"
+
+    @property
+    def lpsn_url(self):
+        return self.url + "lpsn/"
+
+    @property
+    def sso_url(self):
+        return self.url + "auth/"
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/auth/realms/{realm}/protocol/openid-connect/token', self.token)
+        app.router.add_get('/bacdive/taxon/{taxon:.+}', self.bacdive_taxon)
+        app.router.add_get('/bacdive/fetch/{ids}', self.bacdive_fetch)
+        app.router.add_get('/bacdive/culturecollectionno/{item}', self.bacdive_lookup)
+        app.router.add_get('/bacdive/sequence_16s/{item}', self.bacdive_lookup)
+        app.router.add_get('/bacdive/sequence_genome/{item}', self.bacdive_lookup)
+        app.router.add_get('/lpsn/advanced_search', self.lpsn_search)
+        app.router.add_get('/lpsn/flexible_search', self.lpsn_search)
+        app.router.add_get('/lpsn/fetch/{ids}', self.lpsn_fetch)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    # helpers
+
+    def _count(self, endpoint, status):
+        self.stats['endpoints'][endpoint] = self.stats['endpoints'].get(endpoint, 0) + 1
+        self.stats['statuses'][status] = self.stats['statuses'].get(status, 0) + 1
+
+    def _genus(self, record_id):
+        genus = None
+        for start, name in self._genus_of:
+            if record_id < start:
+                break
+            genus = name
+        if genus is None or record_id >= self._offsets[genus] + self.taxa[genus]:
+            return None
+        return genus
+
+    async def _guard(self, request, endpoint):
+        ''' Simulate latency, check the token and inject faults; returns an error response or None '''
+        self.stats['requests'] += 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        auth = request.headers.get('Authorization', '')
+        expires = self.tokens.get(auth[len('Bearer '):])
+        if expires is None or expires < time.time():
+            self._count(endpoint, 401)
+            return web.json_response({'code': 401, 'message': 'Expired token'}, status=401)
+        for status, probability in self.faults.items():
+            if self.random.random() < probability:
+                self._count(endpoint, status)
+                headers = {'Retry-After': str(self.retry_after)} if status in (429, 503) else None
+                return web.json_response({'code': status, 'message': 'Injected fault'},
+                                         status=status, headers=headers)
+        self._count(endpoint, 200)
+        return None
+
+    def _page(self, request, ids):
+        page = int(request.query.get('page', 0))
+        chunk = ids[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+        last = (len(ids) - 1) // PAGE_SIZE
+        url = str(request.url.with_query({k: v for k, v in request.query.items() if k != 'page'}))
+        sep = '&' if '?' in url else '?'
+        return {
+            'count': len(ids),
+            'next': f"{url}{sep}page={page + 1}" if page < last else None,
+            'previous': f"{url}{sep}page={page - 1}" if page > 0 else None,
+            'results': chunk,
+        }
+
+    def _ids(self, genus):
+        if genus not in self.taxa:
+            return []
+        start = self._offsets[genus]
+        return list(range(start, start + self.taxa[genus]))
+
+    # handlers
+
+    async def token(self, request):
+        self.stats['token_requests'] += 1
+        form = await request.post()
+        if form.get('grant_type') == 'refresh_token' and form.get('refresh_token') not in self.tokens:
+            return web.json_response({'error': 'invalid_grant'}, status=400)
+        access = make_token(self.token_lifetime)
+        refresh = make_token(30 * 60, "refresh")
+        self.tokens[access] = time.time() + self.token_lifetime
+        self.tokens[refresh] = time.time() + 30 * 60
+        return web.json_response({'access_token': access, 'refresh_token': refresh,
+                                  'expires_in': self.token_lifetime, 'token_type': 'Bearer'})
+
+    async def bacdive_taxon(self, request):
+        error = await self._guard(request, 'bacdive/taxon')
+        if error is not None:
+            return error
+        genus = request.match_info['taxon'].split('/')[0]
+        return web.json_response(self._page(request, self._ids(genus)))
+
+    async def bacdive_lookup(self, request):
+        error = await self._guard(request, 'bacdive/' + request.path.split('/')[2])
+        if error is not None:
+            return error
+        ids = []
+        for item in request.match_info['item'].split(';'):
+            # accessions look like AB000123 or GCA_000000123.1
+            digits = ''.join(c for c in item.split('.')[0] if c.isdigit())
+            if digits and self._genus(int(digits)) is not None:
+                ids.append(int(digits))
+        return web.json_response(self._page(request, ids))
+
+    async def bacdive_fetch(self, request):
+        error = await self._guard(request, 'bacdive/fetch')
+        if error is not None:
+            return error
+        results = {}
+        for i in request.match_info['ids'].split(';'):
+            genus = self._genus(int(i)) if i.isdigit() else None
+            if genus is not None:
+                results[i] = bacdive_record(int(i), genus, self.payload_size)
+        return web.json_response({'count': len(results), 'next': None, 'previous': None,
+                                  'results': results})
+
+    async def lpsn_search(self, request):
+        error = await self._guard(request, 'lpsn/' + request.path.split('/')[2])
+        if error is not None:
+            return error
+        name = request.query.get('taxon-name')
+        if name is None and 'search' in request.query:
+            try:
+                name = json.loads(request.query['search']).get('genus_name')
+            except (ValueError, AttributeError):
+                name = None
+        genera = [name] if name is not None else list(self.taxa)
+        ids = [i for genus in genera for i in self._ids(genus)]
+        if request.query.get('not') == 'yes':
+            ids = [i for genus in self.taxa if genus not in genera for i in self._ids(genus)]
+        return web.json_response(self._page(request, ids))
+
+    async def lpsn_fetch(self, request):
+        error = await self._guard(request, 'lpsn/fetch')
+        if error is not None:
+            return error
+        results = []
+        for i in request.match_info['ids'].split(';'):
+            genus = self._genus(int(i)) if i.isdigit() else None
+            if genus is not None:
+                results.append(lpsn_record(int(i), genus, self.payload_size))
+        return web.json_response({'count': len(results), 'next': None, 'previous': None,
+                                  'results': results})
@@ -0,0 +1,109 @@
+# Field projection and compact records for the async clients
+from collections import namedtuple
+import re
+
+
+def _select(node, path, sep):
+    ''' Return the part of `node` under `path`, or None if it is missing.
+
+    Keys may themselves contain `sep` (BacDive has "culture collection no."),
+    so the path is matched against the actual keys instead of being split.
+    Lists of dicts (repeated BacDive entries) are projected element-wise.
+    '''
+    if isinstance(node, list):
+        selected = [_select(el, path, sep) for el in node]
+        if all(s is None for s in selected):
+            return None
+        # keep positions so that several fields of one entry merge together
+        return [{} if s is None else s for s in selected]
+    if not isinstance(node, dict):
+        return None
+    if path in node:
+        return {path: node[path]}
+    for key, value in node.items():
+        key = str(key)
+        if path.startswith(key + sep):
+            inner = _select(value, path[len(key) + len(sep):], sep)
+            if inner is not None:
+                return {key: inner}
+    return None
+
+
+def _merge(into, part):
+    for key, value in part.items():
+        if key in into and isinstance(into[key], dict) and isinstance(value, dict):
+            _merge(into[key], value)
+        elif key in into and isinstance(into[key], list) and isinstance(value, list):
+            for a, b in zip(into[key], value):
+                if isinstance(a, dict) and isinstance(b, dict):
+                    _merge(a, b)
+        else:
+            into[key] = value
+    return into
+
+
+def _value(node, path, sep):
+    ''' Return the value at `path` (a list of values below a list), or None '''
+    if isinstance(node, list):
+        values = [_value(el, path, sep) for el in node]
+        values = [v for v in values if v is not None]
+        return values or None
+    if not isinstance(node, dict):
+        return None
+    if path in node:
+        return node[path]
+    for key, value in node.items():
+        key = str(key)
+        if path.startswith(key + sep):
+            return _value(value, path[len(key) + len(sep):], sep)
+    return None
+
+
+def _identifier(name):
+    name = re.sub(r'\W+', '_', name).strip('_').lower()
+    return name if name and not name[0].isdigit() else f"f_{name}"
+
+
+class projection:
+    ''' Reduce records to the given `fields` right after they are fetched.
+
+    Fields are `sep`-joined paths such as
+    "Name and taxonomic classification.species" for BacDive or "full_name"
+    for LPSN; a path ending at a section keeps the whole section. By default
+    the records stay nested dicts holding just those paths. With `compact`
+    every record becomes a namedtuple (no per-instance dict) with one
+    attribute per field, named after the last path segment where unique.
+    '''
+    def __init__(self, fields, compact=False, sep='.'):
+        if isinstance(fields, str):
+            fields = [fields]
+        self.fields = list(fields)
+        self.compact = compact
+        self.sep = sep
+        self.type = None
+        if compact:
+            last = [_identifier(f.split(sep)[-1]) for f in self.fields]
+            names = [n if last.count(n) == 1 else _identifier(f) for n, f in zip(last, self.fields)]
+            self.type = namedtuple('record', names, rename=True)
+
+    def __call__(self, record):
+        if self.compact:
+            return self.type(*(_value(record, f, self.sep) for f in self.fields))
+        projected = {}
+        for field in self.fields:
+            part = _select(record, field, self.sep)
+            if part is not None:
+                _merge(projected, part)
+        return projected
+
+    def many(self, records):
+        return [self(r) for r in records]
+
+
+def projection_for(fields=None, compact=False):
+    ''' projection for `fields`, None if every field is wanted '''
+    if fields is None:
+        return None
+    if isinstance(fields, projection):
+        return fields
+    return projection(fields, compact)
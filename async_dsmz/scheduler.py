@@ -0,0 +1,101 @@
+# Priority classes and per-query fair queuing of requests waiting for a slot
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from .metrics import current_summary
+
+PRIORITIES = {'interactive': 0, 'normal': 1, 'bulk': 2}
+
+request_priority = ContextVar('async_dsmz_request_priority', default='normal')
+request_flow = ContextVar('async_dsmz_request_flow', default=None)
+
+
+@contextmanager
+def priority(level, flow=None):
+    ''' Send the requests made inside the block with priority `level`
+    ('interactive', 'normal' or 'bulk'), optionally as their own `flow`.
+
+        with priority('interactive'):
+            handle = await client.async_query(taxonomy='Aquifex')
+
+    Tasks started inside the block, such as the workers of retrieve_async,
+    inherit the priority.
+    '''
+    if level not in PRIORITIES:
+        raise ValueError(f"Unknown priority {level!r}, use one of {', '.join(PRIORITIES)}")
+    level_token = request_priority.set(level)
+    flow_token = request_flow.set(flow) if flow is not None else None
+    try:
+        yield
+    finally:
+        request_priority.reset(level_token)
+        if flow_token is not None:
+            request_flow.reset(flow_token)
+
+
+def current_flow():
+    ''' The flow of the running request: the one set with priority(), else the
+    retrieval it belongs to, so every retrieve_async/aiter_records call is
+    queued separately and single searches share one flow. '''
+    flow = request_flow.get()
+    if flow is None:
+        flow = current_summary.get()
+    return flow
+
+
+class fair_queue:
+    ''' Waiters of an adaptive_limiter, served by priority class and round-robin
+    between the flows of a class.
+
+    A bulk retrieval queuing hundreds of pages therefore no longer delays an
+    interactive lookup, and two retrievals of the same class share the free
+    slots evenly instead of first come, first served. Higher classes are
+    served strictly first. With a single class and flow it is a plain FIFO.
+    '''
+    def __init__(self):
+        # priority -> {flow: deque of waiters}, flows in round-robin order
+        self._classes = {}
+        self._where = {}
+
+    def append(self, waiter):
+        level = PRIORITIES[request_priority.get()]
+        flow = current_flow()
+        flows = self._classes.setdefault(level, OrderedDict())
+        flows.setdefault(flow, deque()).append(waiter)
+        self._where[waiter] = (level, flow)
+
+    def popleft(self):
+        level = min(self._classes)
+        flows = self._classes[level]
+        flow, waiters = next(iter(flows.items()))
+        waiter = waiters.popleft()
+        if waiters:
+            # next turn goes to the next flow
+            flows.move_to_end(flow)
+        else:
+            del flows[flow]
+            if not flows:
+                del self._classes[level]
+        del self._where[waiter]
+        return waiter
+
+    def remove(self, waiter):
+        level, flow = self._where.pop(waiter)
+        flows = self._classes[level]
+        flows[flow].remove(waiter)
+        if not flows[flow]:
+            del flows[flow]
+            if not flows:
+                del self._classes[level]
+
+    def waiting(self):
+        ''' {priority: {flow: number of waiters}} '''
+        names = {v: k for k, v in PRIORITIES.items()}
+        return {names[level]: {flow: len(w) for flow, w in flows.items()}
+                for level, flows in sorted(self._classes.items())}
+
+    def __contains__(self, waiter):
+        return waiter in self._where
+
+    def __len__(self):
+        return len(self._where)
@@ -0,0 +1,28 @@
+# Per-query search handles used by the async clients
+
+
+class search_result:
+    ''' Outcome of one search: the query, its listing URL and first response.
+
+    Handles let a single client run many searches concurrently instead of
+    keeping one search in self.url/self.result.
+    '''
+    def __init__(self, query, url=None, result=None):
+        self.query = query
+        self.url = url
+        self.result = result
+        # retrieval_summary of the last retrieval of this handle
+        self.summary = None
+        # pages and fetch batches that failed in a checkpointed retrieval
+        self.failed = None
+        # projection applied to the records when the handle is retrieved
+        self.projection = None
+
+    @property
+    def count(self):
+        if isinstance(self.result, dict):
+            return self.result.get('count', 0)
+        return 0
+
+    def __repr__(self):
+        return f"search_result({self.query!r}, count={self.count})"
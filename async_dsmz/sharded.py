@@ -0,0 +1,206 @@
+# Multi-process sharded retrieval for very large pulls
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import multiprocessing
+import multiprocessing.util
+import os
+import queue
+from .async_bacdive import bacdive_async
+from .async_lpsn import lpsn_async
+from .batching import chunked, unique
+from .export import export_async
+from .limiter import adaptive_limiter, budget_limiter, request_budget
+
+CLIENTS = {'bacdive': bacdive_async, 'lpsn': lpsn_async}
+
+# state of a worker process, set by _init_worker; the loop and client are added by its first shard
+_worker = {}
+
+
+def _init_worker(api, user, password, options, budget, results, stop):
+    _worker.update(api=api, user=user, password=password, options=options, budget=budget,
+                   results=results, stop=stop)
+    # pool workers leave through os._exit, which skips atexit but not multiprocessing finalizers
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+
+
+def _close_worker():
+    loop = _worker.pop('loop', None)
+    if loop is None:
+        return
+    client = _worker.pop('client', None)
+    if client is not None:
+        loop.run_until_complete(client.close())
+    loop.close()
+
+
+async def _client():
+    ''' The client of this worker process, created by its first shard and reused by the following ones '''
+    if 'client' not in _worker:
+        api = _worker['api']
+        client = await CLIENTS[api].create(_worker['user'], _worker['password'], **_worker['options'])
+        if _worker['budget'] is not None:
+            client.limiter = budget_limiter(_worker['budget'], adaptive_limiter(**CLIENTS[api].limits))
+        _worker['client'] = client
+    return _worker['client']
+
+
+async def _send(shard, records):
+    ''' Put records on the result queue without blocking the loop, giving up once the crawl is stopped '''
+    while not _worker['stop'].is_set():
+        try:
+            await asyncio.to_thread(_worker['results'].put, (shard, records), True, 0.5)
+            return
+        except queue.Full:
+            continue
+    raise RuntimeError("crawl stopped")
+
+
+async def _crawl_shard(shard, queries, path, format, concurrency, fields, compact, options):
+    n = 0
+    try:
+        client = await _client()
+        results = client.search_many(queries, concurrency, fields=fields, compact=compact)
+        if path is not None:
+            return await export_async((entry async for query, entries in results for entry in entries),
+                                      path, format, **options)
+        async for query, entries in results:
+            if entries:
+                await _send(shard, entries)
+                n += len(entries)
+    finally:
+        if path is None:
+            # tells the parent this shard sends nothing more
+            await _send(shard, None)
+    return n
+
+
+def _run_shard(shard, queries, path=None, format=None, concurrency=20, fields=None, compact=False, options=None):
+    # one loop per worker process, so the client's session, connections and token outlive the shard
+    if 'loop' not in _worker:
+        _worker['loop'] = asyncio.new_event_loop()
+        asyncio.set_event_loop(_worker['loop'])
+    return _worker['loop'].run_until_complete(
+        _crawl_shard(shard, queries, path, format, concurrency, fields, compact, options or {}))
+
+
+class sharded_crawler:
+    ''' Spread a very large retrieval over a pool of worker processes.
+
+    One event loop runs out of CPU (JSON decoding, building dicts,
+    flattening) long before the DSMZ APIs are saturated. The crawler splits
+    the work into shards of `shard_size` IDs or `queries_per_shard` search
+    queries (async_query parameter dicts). Each worker process builds one
+    `api` client ('bacdive' or 'lpsn', with create(**client_options)) on its
+    first shard and reuses it, with its connections and token, for every
+    later shard. With `rate` every worker draws its requests from one
+    request_budget, so the whole pool stays under `rate` requests per
+    second. write() leaves one file per shard, records() streams the
+    records back to this process.
+
+    Worker processes are spawned, so call it under `if __name__ == "__main__":`
+    in scripts.
+    '''
+    def __init__(self, api, user, password, processes=None, rate=None, burst=None, shard_size=5000,
+                 queries_per_shard=50, concurrency=20, **client_options):
+        if api not in CLIENTS:
+            raise ValueError(f"Unknown API {api!r}, use one of {', '.join(CLIENTS)}")
+        self.api = api
+        self.user = user
+        self.password = password
+        self.processes = processes or os.cpu_count()
+        self.rate = rate
+        self.burst = burst
+        self.shard_size = shard_size
+        self.queries_per_shard = queries_per_shard
+        self.concurrency = concurrency
+        self.client_options = client_options
+        self.budget = None
+        # {shard: error} of the last run
+        self.failed = {}
+
+    def shards(self, ids=None, queries=None):
+        ''' Split IDs and queries into shards, each a list of async_query parameter dicts '''
+        shards = []
+        if ids is not None:
+            shards += [[{'id': chunk}] for chunk in chunked(unique(ids), self.shard_size)]
+        if queries is not None:
+            queries = list(queries)
+            shards += [queries[i:i + self.queries_per_shard] for i in range(0, len(queries), self.queries_per_shard)]
+        return shards
+
+    def _pool(self, context, results=None, stop=None):
+        self.budget = request_budget(self.rate, self.burst, context) if self.rate else None
+        self.failed = {}
+        return ProcessPoolExecutor(self.processes, mp_context=context, initializer=_init_worker,
+                                   initargs=(self.api, self.user, self.password, self.client_options,
+                                             self.budget, results, stop))
+
+    def write(self, out_dir, ids=None, queries=None, format='jsonl', fields=None, compact=False, **options):
+        ''' Retrieve every shard into its own file in `out_dir` ('jsonl', 'jsonl.gz'
+        or 'parquet'; `options` configure the flattening, see export_async).
+        Returns {path: number of records}; failed shards are kept in self.failed.
+        '''
+        os.makedirs(out_dir, exist_ok=True)
+        shards = self.shards(ids, queries)
+        extension = format
+        format = 'jsonl' if format == 'jsonl.gz' else format
+        written = {}
+        context = multiprocessing.get_context('spawn')
+        with self._pool(context) as pool:
+            futures = {}
+            for n, shard in enumerate(shards):
+                path = os.path.join(out_dir, f"shard-{n:05d}.{extension}")
+                futures[pool.submit(_run_shard, n, shard, path, format, self.concurrency, fields, compact,
+                                    options)] = (n, path)
+            for future in as_completed(futures):
+                n, path = futures[future]
+                try:
+                    written[path] = future.result()
+                except Exception as e:
+                    print(f"Shard {n} failed: {e}")
+                    self.failed[n] = e
+        return dict(sorted(written.items()))
+
+    def records(self, ids=None, queries=None, fields=None, compact=False):
+        ''' Yield records as the worker processes send them back, shard by shard
+        in completion order. Records are pickled across processes, so write()
+        scales further when the results go to disk anyway.
+        '''
+        shards = self.shards(ids, queries)
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue(maxsize=4 * self.processes)
+        stop = context.Event()
+        with self._pool(context, results, stop) as pool:
+            futures = {pool.submit(_run_shard, n, shard, None, None, self.concurrency, fields, compact): n
+                       for n, shard in enumerate(shards)}
+            open_shards = set(range(len(shards)))
+            try:
+                while open_shards:
+                    try:
+                        n, records = results.get(timeout=0.5)
+                    except queue.Empty:
+                        for future, n in futures.items():
+                            # a dead worker process never sends the end of its shard
+                            if future.done() and isinstance(future.exception(), BrokenProcessPool):
+                                open_shards.discard(n)
+                        continue
+                    if records is None:
+                        open_shards.discard(n)
+                    else:
+                        yield from records
+            finally:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                # let running shards notice the stop instead of blocking on a full queue
+                while not all(future.done() for future in futures):
+                    try:
+                        results.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            for future, n in futures.items():
+                if not future.cancelled() and future.exception() is not None:
+                    print(f"Shard {n} failed: {future.exception()}")
+                    self.failed[n] = future.exception()
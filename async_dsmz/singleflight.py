@@ -0,0 +1,87 @@
+# Deduplication of identical in-flight API calls
+import asyncio
+import copy
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_copy(data):
+    ''' Deep copy of decoded JSON, via orjson when available (much faster than deepcopy) '''
+    if orjson is not None:
+        try:
+            return orjson.loads(orjson.dumps(data))
+        except TypeError:
+            pass
+    return copy.deepcopy(data)
+
+
+class single_flight:
+    ''' Share one in-flight call between concurrent callers with the same key.
+
+    The first caller starts `call()`; callers arriving while it runs await the
+    same task instead of sending their own request. The first caller gets the
+    result itself and every other caller an independent copy, so callers can
+    modify their result freely. The shared task is shielded, so one caller
+    being cancelled does not cancel the request for the others, but it is
+    cancelled once every caller waiting for it has been.
+    '''
+    def __init__(self):
+        self._calls = {}
+        # task -> number of callers awaiting it
+        self._waiters = {}
+        self.shared = 0
+        # called for every caller that joined a running call, e.g. to count it
+        self.on_shared = None
+
+    async def do(self, key, call):
+        # a task can only be awaited on its own loop, so each loop has its own calls
+        key = (asyncio.get_running_loop(), key)
+        task = self._calls.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            self._waiters[task] = 0
+
+            def done(finished):
+                if self._calls.get(key) is finished:
+                    del self._calls[key]
+                self._waiters.pop(finished, None)
+
+            task.add_done_callback(done)
+        else:
+            self.shared += 1
+            if self.on_shared is not None:
+                self.on_shared()
+        self._waiters[task] += 1
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            if task in self._waiters:
+                self._waiters[task] -= 1
+                if not self._waiters[task] and not task.done():
+                    # the last caller gave up, nobody needs the response anymore
+                    self._forget(key, task)
+        return result if leader else json_copy(result)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        self._waiters.pop(task, None)
+        task.cancel()
+
+    def cancel(self):
+        ''' Cancel every call in flight, e.g. when the client is closed '''
+        for key, task in list(self._calls.items()):
+            loop = task.get_loop()
+            if loop is asyncio.get_running_loop():
+                self._forget(key, task)
+            elif not loop.is_closed():
+                # the call runs on another thread's loop, e.g. the background loop
+                loop.call_soon_threadsafe(self._forget, key, task)
+
+    def __len__(self):
+        return len(self._calls)
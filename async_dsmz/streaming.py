@@ -0,0 +1,30 @@
+# Helpers for streaming results out of the async clients
+import asyncio
+
+
+async def bounded_as_completed(aws, window=50):
+    ''' Run awaitables with at most `window` in flight and yield their results
+    in completion order.
+
+    New awaitables are only started once the consumer has taken the results of
+    finished ones, so a slow consumer throttles the producer instead of letting
+    results pile up in memory. Pending tasks are cancelled if the consumer stops early.
+    '''
+    aws = iter(aws)
+    pending = set()
+    try:
+        for aw in aws:
+            pending.add(asyncio.ensure_future(aw))
+            if len(pending) >= window:
+                break
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+            for aw in aws:
+                pending.add(asyncio.ensure_future(aw))
+                if len(pending) >= window:
+                    break
+    finally:
+        for task in pending:
+            task.cancel()
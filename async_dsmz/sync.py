@@ -0,0 +1,75 @@
+# Blocking facade over the async clients
+from .async_bacdive import bacdive_async
+from .async_lpsn import lpsn_async
+from .background import shared_loop
+
+
+class sync_client:
+    ''' Blocking search/retrieve/stream on top of bacdive_async or lpsn_async.
+
+    The async client lives on a background_loop (the process-wide one by
+    default), so consecutive calls reuse its connection pool and tokens
+    instead of paying for a new loop, session and TLS handshakes each time.
+    search() returns a search_result handle to pass on to retrieve() or
+    stream(), so threads can share one sync_client without racing on
+    self.url/self.result.
+
+        with sync_client.bacdive(user, password) as client:
+            handle = client.search(taxonomy='Bacillus')
+            for record in client.stream(handle):
+                ...
+    '''
+    def __init__(self, client, loop=None):
+        self.client = client
+        self.loop = loop or shared_loop()
+        self.loop.track(client)
+
+    @classmethod
+    def bacdive(cls, user, password, loop=None, **options):
+        ''' Authenticate a bacdive_async on the loop; `options` go to bacdive_async.create '''
+        loop = loop or shared_loop()
+        return cls(loop.run(bacdive_async.create(user, password, **options)), loop)
+
+    @classmethod
+    def lpsn(cls, user, password, loop=None, **options):
+        ''' Authenticate an lpsn_async on the loop; `options` go to lpsn_async.create '''
+        loop = loop or shared_loop()
+        return cls(loop.run(lpsn_async.create(user, password, **options)), loop)
+
+    def run(self, coro, timeout=None):
+        ''' Run any coroutine of the client, e.g. client.run(client.client.fetch_map_async(ids)) '''
+        return self.loop.run(coro, timeout)
+
+    def search(self, fields=None, compact=False, **params):
+        ''' Search with the parameters of the client's async_query and return the handle '''
+        return self.run(self.client.async_query(fields, compact, **params))
+
+    def flex_search(self, search, negate=False, fields=None, compact=False):
+        ''' LPSN flexible search, returns the handle '''
+        return self.run(self.client.async_flex_query(search, negate, fields, compact))
+
+    def retrieve(self, handle=None, **options):
+        ''' All entries of `handle` (default: the client's current search), see retrieve_async '''
+        return self.run(self.client.retrieve_async(handle=handle, **options))
+
+    def retrieve_many(self, handles, **options):
+        ''' Iterate over (handle, entries) as each handle completes, see retrieve_many '''
+        return self.loop.iterate(self.client.retrieve_many(handles, **options))
+
+    def stream(self, handle=None, **options):
+        ''' Iterate over the entries of `handle` as they arrive, see aiter_records '''
+        return self.loop.iterate(self.client.aiter_records(handle=handle, **options))
+
+    def export(self, path, handle=None, **options):
+        ''' Write the entries of `handle` to a JSONL or Parquet file, see export_async '''
+        return self.run(self.client.export_async(path, handle=handle, **options))
+
+    def close(self):
+        if self.client.session is not None:
+            self.run(self.client.close())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,78 @@
+# Shared Keycloak token handling for the async clients
+from keycloak.exceptions import KeycloakAuthenticationError, KeycloakPostError
+import asyncio
+import base64
+import json
+import time
+
+
+def token_expiry(access_token):
+    ''' Return the `exp` claim of a JWT access token (unverified) or None '''
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['exp']
+    except Exception:
+        return None
+
+
+class token_manager:
+    ''' Keep the access/refresh token pair of a client fresh without blocking the loop.
+
+    The synchronous Keycloak call runs in a worker thread (clients built with
+    create() refresh over aiohttp through `refresh_call`), concurrent refreshes
+    share a single in-flight call, and tokens are renewed `leeway` seconds
+    before the access token expires (15 minutes life time on DSMZ). Once the
+    refresh token has expired as well, `login_call` logs in again.
+    '''
+    def __init__(self, keycloak_openid, access_token, refresh_token, leeway=60, refresh_call=None,
+                 login_call=None):
+        self.keycloak_openid = keycloak_openid
+        # async callable(refresh_token) -> token dict, used instead of the Keycloak
+        # call in a worker thread, e.g. to refresh over the client's aiohttp session
+        self.refresh_call = refresh_call
+        # async callable() -> token dict of a new password login, None to give up
+        self.login_call = login_call
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.leeway = leeway
+        self.refreshes = 0
+        # called once per Keycloak refresh, e.g. to count it in metrics
+        self.on_refresh = None
+        self._refreshing = None
+
+    def expires_soon(self):
+        exp = token_expiry(self.access_token)
+        return exp is not None and exp - time.time() < self.leeway
+
+    async def refresh(self, stale=None):
+        ''' Refresh the tokens and return the new token dict.
+
+        If `stale` is given and no longer the current access token another
+        caller has already refreshed it, so no new Keycloak call is made.
+        '''
+        if stale is not None and stale != self.access_token:
+            return {'access_token': self.access_token, 'refresh_token': self.refresh_token}
+        if (self._refreshing is None or self._refreshing.done()
+                or self._refreshing.get_loop() is not asyncio.get_running_loop()):
+            self._refreshing = asyncio.ensure_future(self._refresh())
+        # shield so one cancelled caller does not abort the refresh for everybody
+        return await asyncio.shield(self._refreshing)
+
+    async def _refresh(self):
+        try:
+            if self.refresh_call is not None:
+                token = await self.refresh_call(self.refresh_token)
+            else:
+                token = await asyncio.to_thread(self.keycloak_openid.refresh_token, self.refresh_token)
+        except (KeycloakAuthenticationError, KeycloakPostError) as e:
+            # Keycloak answers invalid_grant (400) once the refresh token has expired too
+            if self.login_call is None or e.response_code not in (400, 401):
+                raise
+            token = await self.login_call()
+        self.access_token = token['access_token']
+        self.refresh_token = token['refresh_token']
+        self.refreshes += 1
+        if self.on_refresh is not None:
+            self.on_refresh()
+        return token
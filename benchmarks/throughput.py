@@ -0,0 +1,150 @@
+''' Throughput benchmark for bacdive_async and lpsn_async against the local mock server.
+
+Every (client, dataset size) case runs in a fresh process so that peak RSS is
+measured per case, and the mock server runs in a process of its own so that
+neither its CPU time nor its memory is counted against the client. Reports
+records/sec, p50/p99 request latency, peak RSS of the client and the number
+of requests the mock server received.
+
+    python benchmarks/throughput.py --sizes 100 1000 10000 --latency 0.05
+
+It runs from a checkout without installing the package (or after `pip install -e .`).
+'''
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+# the checkout's async_dsmz, also in the spawned worker processes
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_dsmz import bacdive_async, lpsn_async
+from async_dsmz.mock_server import mock_dsmz_server
+
+
+def timed(cls):
+    ''' Subclass a client so that every do_request_async call is timed '''
+    class timed_client(cls):
+        async def do_request_async(self, url):
+            start = time.perf_counter()
+            try:
+                return await super().do_request_async(url)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+    return timed_client
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def serve(size, options, conn):
+    ''' Run the mock server until the parent asks for its stats '''
+    async with mock_dsmz_server(taxa={'Benchmarkia': size}, latency=options['latency'],
+                                jitter=options['jitter'], payload_size=options['payload_size'],
+                                faults=options['faults'], seed=options['seed']) as server:
+        conn.send({'sso_url': server.sso_url, 'bacdive_url': server.bacdive_url, 'lpsn_url': server.lpsn_url})
+        await asyncio.to_thread(conn.recv)
+        conn.send(server.stats)
+
+
+def server_process(size, options, conn):
+    asyncio.run(serve(size, options, conn))
+
+
+async def run_case(api, size, urls):
+    if api == 'bacdive':
+        client = await asyncio.to_thread(timed(bacdive_async), 'user', 'password',
+                                         sso_url=urls['sso_url'], api_url=urls['bacdive_url'])
+    else:
+        client = await asyncio.to_thread(timed(lpsn_async), 'user', 'password',
+                                         sso_url=urls['sso_url'], api_url=urls['lpsn_url'])
+    client.latencies = []
+    start = time.perf_counter()
+    if api == 'bacdive':
+        await client.async_search(taxonomy='Benchmarkia')
+    else:
+        await client.async_search(taxon_name='Benchmarkia')
+    records = await client.retrieve_async()
+    elapsed = time.perf_counter() - start
+    await client.close()
+    return {
+        'api': api,
+        'size': size,
+        'records': len(records),
+        'seconds': round(elapsed, 3),
+        'records_per_sec': round(len(records) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(client.latencies, 0.50) * 1000, 1),
+        'p99_ms': round(percentile(client.latencies, 0.99) * 1000, 1),
+        # ru_maxrss is in kilobytes on Linux; only the client runs in this process
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def case(api, size, urls):
+    return asyncio.run(run_case(api, size, urls))
+
+
+def run(ctx, api, size, options):
+    ''' Run one case in a fresh client process against a mock server in another process '''
+    conn, server_conn = ctx.Pipe()
+    server = ctx.Process(target=server_process, args=(size, options, server_conn), daemon=True)
+    server.start()
+    try:
+        urls = conn.recv()
+        with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+            result = pool.submit(case, api, size, urls).result()
+        conn.send('stop')
+        stats = conn.recv()
+    finally:
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+    result.update(requests=stats['requests'], statuses=stats['statuses'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--api', nargs='+', default=['bacdive', 'lpsn'], choices=['bacdive', 'lpsn'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0.01, help="random extra latency in seconds")
+    parser.add_argument('--payload-size', type=int, default=2000, help="padding bytes per record")
+    parser.add_argument('--fault', action='append', default=[], metavar='STATUS=P',
+                        help="inject an error status with probability P, e.g. 429=0.02")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    options = {
+        'latency': args.latency,
+        'jitter': args.jitter,
+        'payload_size': args.payload_size,
+        'faults': {int(k): float(v) for k, v in (f.split('=') for f in args.fault)},
+        'seed': args.seed,
+    }
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for api in args.api:
+        for size in args.sizes:
+            r = run(ctx, api, size, options)
+            results.append(r)
+            print(f"{r['api']:8} {r['size']:>7} records  {r['records_per_sec']:>9} rec/s  "
+                  f"p50 {r['p50_ms']:>7} ms  p99 {r['p99_ms']:>7} ms  "
+                  f"rss {r['peak_rss_mb']:>7} MB  requests {r['requests']:>5}  {r['statuses']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
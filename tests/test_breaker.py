@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+from async_dsmz.breaker import breaker_for, circuit_breaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = circuit_breaker(failures=3, reset_after=60)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.state == 'closed'
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count():
+    breaker = circuit_breaker(failures=2)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == 'closed'
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = circuit_breaker(failures=1, reset_after=0.05)
+    breaker.failure()
+    assert breaker.state == 'open'
+    time.sleep(0.06)
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_failed_probe_opens_the_circuit_again():
+    breaker = circuit_breaker(failures=1, reset_after=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open'
+
+
+def test_abandoned_probe_frees_the_half_open_slot():
+    breaker = circuit_breaker(failures=1, reset_after=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.abandon()
+    assert breaker.allow()
+
+
+def test_one_breaker_per_host_and_loop():
+    async def pair():
+        return breaker_for('example.org'), breaker_for('example.org')
+
+    first, again = asyncio.run(pair())
+    other, _ = asyncio.run(pair())
+    assert first is again
+    assert first is not other
@@ -0,0 +1,52 @@
+import asyncio
+import os
+
+import pytest
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.parquet  # noqa: E402
+
+from async_dsmz.export import export_async, parquet_writer  # noqa: E402
+
+
+def test_new_columns_start_parts_that_are_merged(tmp_path):
+    path = str(tmp_path / 'out.parquet')
+    writer = parquet_writer(path)
+    writer.write([{'a': 1}, {'a': 2}])
+    writer.write([{'a': 3, 'b': 'x'}])
+    writer.write([{'c': 4.5}])
+    writer.close()
+
+    table = pyarrow.parquet.read_table(path)
+    assert table.column_names == ['a', 'b', 'c']
+    assert table.to_pylist() == [
+        {'a': '1', 'b': None, 'c': None},
+        {'a': '2', 'b': None, 'c': None},
+        {'a': '3', 'b': 'x', 'c': None},
+        {'a': None, 'b': None, 'c': '4.5'},
+    ]
+    # the part files are removed after merging
+    assert os.listdir(tmp_path) == ['out.parquet']
+
+
+def test_single_part_is_renamed(tmp_path):
+    path = str(tmp_path / 'out.parquet')
+    writer = parquet_writer(path)
+    writer.write([{'a': 1, 'b': 2}])
+    writer.write([{'b': 3}])
+    writer.close()
+    assert os.listdir(tmp_path) == ['out.parquet']
+    assert pyarrow.parquet.read_table(path).num_rows == 2
+
+
+def test_export_flattens_nested_records(tmp_path):
+    async def records():
+        yield {'General': {'BacDive-ID': 1}}
+        yield {'General': {'BacDive-ID': 2, 'keywords': ['a', 'b']}}
+
+    path = str(tmp_path / 'out.parquet')
+    n = asyncio.run(export_async(records(), path, batch_size=1))
+    table = pyarrow.parquet.read_table(path)
+    assert n == 2
+    assert table.column('General.BacDive-ID').to_pylist() == ['1', '2']
+    assert 'General.keywords' in table.column_names
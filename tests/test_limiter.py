@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+from async_dsmz.limiter import adaptive_limiter, parse_retry_after
+
+
+def test_released_slot_goes_to_the_next_waiter():
+    async def main():
+        limiter = adaptive_limiter(initial=1, maximum=1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.release()
+        # a newcomer arriving after the release cannot take the handed over slot
+        newcomer = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        handed_over = waiter.done() and not newcomer.done()
+        limiter.release()
+        await newcomer
+        return handed_over, limiter.in_flight
+
+    assert asyncio.run(main()) == (True, 1)
+
+
+def test_cancelled_waiter_does_not_leak_its_slot():
+    async def main():
+        limiter = adaptive_limiter(initial=1, maximum=1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return limiter.in_flight, len(limiter._waiters)
+
+    assert asyncio.run(main()) == (0, 0)
+
+
+def test_retry_after_pauses_new_requests():
+    async def main():
+        limiter = adaptive_limiter(initial=4)
+        limiter.on_throttle(0.2)
+        start = time.monotonic()
+        await limiter.acquire()
+        return time.monotonic() - start, limiter.limit
+
+    waited, limit = asyncio.run(main())
+    assert waited >= 0.19
+    assert limit == 2
+
+
+def test_retry_after_pause_holds_back_waiters():
+    async def main():
+        limiter = adaptive_limiter(initial=1, maximum=1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        start = time.monotonic()
+        limiter.on_throttle(0.2)
+        limiter.release()
+        await waiter
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) >= 0.19
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
@@ -0,0 +1,98 @@
+import asyncio
+
+from aiohttp import web
+
+from async_dsmz import bacdive_async, lpsn_async, retrieval_checkpoint
+from async_dsmz.mock_server import mock_dsmz_server
+
+
+def run(test, cls=bacdive_async, taxa=None, **client_options):
+    ''' Run `test(server, client)` against a fresh mock server '''
+    async def main():
+        async with mock_dsmz_server(taxa=taxa or {'Bacillus': 250}) as server:
+            api_url = server.bacdive_url if cls is bacdive_async else server.lpsn_url
+            async with await cls.create('user', 'password', sso_url=server.sso_url, api_url=api_url,
+                                        **client_options) as client:
+                return await test(server, client)
+    return asyncio.run(main())
+
+
+def ids_of(entries):
+    return sorted(entry['General']['BacDive-ID'] for entry in entries)
+
+
+def test_search_response_is_reused_as_page_0():
+    async def test(server, client):
+        assert await client.async_search(taxonomy='Bacillus') == 250
+        entries = await client.retrieve_async()
+        return entries, dict(server.stats['endpoints'])
+
+    entries, endpoints = run(test)
+    assert ids_of(entries) == list(range(1, 251))
+    # page 0 came with the search, pages 1 and 2 are listed, 250 IDs take 3 fetch/ batches
+    assert endpoints == {'bacdive/taxon': 3, 'bacdive/fetch': 3}
+
+
+def test_retrieving_a_url_lists_every_page_once():
+    async def test(server, client):
+        entries = await client.retrieve_async('taxon/Bacillus')
+        return entries, dict(server.stats['endpoints'])
+
+    entries, endpoints = run(test)
+    assert len(entries) == 250
+    assert endpoints == {'bacdive/taxon': 3, 'bacdive/fetch': 3}
+
+
+def test_lpsn_search_is_retrieved_completely():
+    async def test(server, client):
+        assert await client.async_search(taxon_name='Bacillus') == 250
+        entries = await client.retrieve_async()
+        return entries, server.stats['endpoints']['lpsn/advanced_search']
+
+    entries, listings = run(test, lpsn_async)
+    assert sorted(entry['id'] for entry in entries) == list(range(1, 251))
+    assert listings == 3
+
+
+def test_checkpoint_resumes_only_the_missing_work(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.sqlite')
+
+    async def test(server, client):
+        guard = server._guard
+
+        async def failing(request, endpoint):
+            # every fetch/ batch holding record 150 fails
+            if endpoint == 'bacdive/fetch' and '150' in request.match_info['ids'].split(';'):
+                server.stats['requests'] += 1
+                return web.json_response({'code': 500, 'message': 'Injected fault'}, status=500)
+            return await guard(request, endpoint)
+
+        server._guard = failing
+        first = await client.retrieve_async('taxon/Bacillus', checkpoint=checkpoint)
+        failed = client.last_summary.failed
+        server._guard = guard
+        requests = server.stats['requests']
+        second = await client.retrieve_async('taxon/Bacillus', checkpoint=checkpoint)
+        return first, failed, second, server.stats['requests'] - requests
+
+    first, failed, second, requests = run(test, max_retries=1)
+    assert len(first) == 150
+    assert len(failed['batches']) == 1 and not failed['pages']
+    assert ids_of(second) == list(range(1, 251))
+    # the search itself and the one batch that failed
+    assert requests == 2
+    assert retrieval_checkpoint(checkpoint).failed_batches() == []
+
+
+def test_stream_does_not_count_the_consumers_requests():
+    async def test(server, client):
+        n = 0
+        async for _ in client.aiter_records('taxon/Bacillus'):
+            n += 1
+            if n == 1:
+                await client.do_api_call_async('fetch/1', cached=False)
+        return n, client.last_summary
+
+    n, summary = run(test)
+    assert n == summary.records == 250
+    assert summary.requests == 6
@@ -0,0 +1,38 @@
+from async_dsmz.scheduler import fair_queue, priority
+
+
+def queue(*waiters):
+    ''' Fill a fair_queue with (waiter, level, flow) tuples '''
+    q = fair_queue()
+    for waiter, level, flow in waiters:
+        with priority(level, flow):
+            q.append(waiter)
+    return q
+
+
+def drain(q):
+    return [q.popleft() for _ in range(len(q))]
+
+
+def test_single_flow_is_fifo():
+    q = queue(*[(n, 'normal', 'a') for n in range(4)])
+    assert drain(q) == [0, 1, 2, 3]
+
+
+def test_flows_of_a_class_take_turns():
+    q = queue(('a1', 'bulk', 'a'), ('a2', 'bulk', 'a'), ('a3', 'bulk', 'a'),
+              ('b1', 'bulk', 'b'), ('b2', 'bulk', 'b'))
+    assert drain(q) == ['a1', 'b1', 'a2', 'b2', 'a3']
+
+
+def test_higher_classes_are_served_first():
+    q = queue(('bulk', 'bulk', 'a'), ('normal', 'normal', 'b'), ('interactive', 'interactive', 'c'))
+    assert drain(q) == ['interactive', 'normal', 'bulk']
+
+
+def test_removed_waiters_are_skipped():
+    q = queue(('a1', 'normal', 'a'), ('b1', 'normal', 'b'), ('a2', 'normal', 'a'))
+    q.remove('b1')
+    assert 'b1' not in q
+    assert q.waiting() == {'normal': {'a': 2}}
+    assert drain(q) == ['a1', 'a2']
@@ -0,0 +1,68 @@
+import asyncio
+
+from async_dsmz.singleflight import single_flight
+
+
+def test_callers_share_one_call():
+    async def main():
+        flight = single_flight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {'results': [1]}
+
+        results = await asyncio.gather(*[flight.do('fetch/1', call) for _ in range(5)])
+        return calls, results, flight.shared
+
+    calls, results, shared = asyncio.run(main())
+    assert len(calls) == 1
+    assert shared == 4
+    assert all(r == {'results': [1]} for r in results)
+    # every caller may modify its result
+    assert len({id(r) for r in results}) == 5
+
+
+def test_cancelling_the_leader_keeps_the_call_for_the_others():
+    async def main():
+        flight = single_flight()
+        started = asyncio.Event()
+
+        async def call():
+            started.set()
+            await asyncio.sleep(0.05)
+            return 'done'
+
+        leader = asyncio.ensure_future(flight.do('key', call))
+        await started.wait()
+        follower = asyncio.ensure_future(flight.do('key', call))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower, leader.cancelled()
+
+    assert asyncio.run(main()) == ('done', True)
+
+
+def test_cancelling_the_last_caller_cancels_the_call():
+    async def main():
+        flight = single_flight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def call():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.ensure_future(flight.do('key', call)) for _ in range(2)]
+        await started.wait()
+        for caller in callers:
+            caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return len(flight)
+
+    assert asyncio.run(main()) == 0